@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark for the --group-by/--agg folding in ec2aggregate.py, with
+# numpy and with the array.array fallback, over a synthetic inventory; and
+# a check that both come up with the same groups. Exits non-zero if they
+# don't. Without numpy installed, only the fallback runs.
+#
+#   ./bench/bench_aggregate.py [--count 100000] [--group-by zone,type]
+#
+import os
+import sys
+import time
+import random
+from operator   import itemgetter
+from optparse   import OptionParser
+
+sys.path.insert( 0, os.path.join( os.path.dirname( __file__ ), '..' ) )
+
+import ec2aggregate
+from ec2aggregate import Aggregator, parse_group_by, parse_aggregates
+
+ZONES   = [ 'us-east-1a', 'us-east-1b', 'us-east-1c', 'us-east-1d' ]
+TYPES   = [ 'gp2', 'gp2', 'io1', 'standard' ]
+STATUS  = [ 'in-use' ] * 4 + [ 'available', 'creating' ]
+SIZES   = [ 8, 50, 100, 500, 1000 ]
+
+FIELDS  = dict( [ ( name, itemgetter( name ) ) for name in
+                    [ 'zone', 'type', 'status', 'size' ] ] )
+
+def synthetic_volumes( count, seed=42 ):
+    """rows shaped like ec2inventory.volume_row(), some without a size, and
+       some with a numeric 'cost' tag"""
+    rnd = random.Random( seed )
+    return [ { 'id':     'vol-%08x' % n,
+               'tags':   { 'cost': str( rnd.randint( 1, 100 ) ) } if rnd.random() < 0.7 else {},
+               'zone':   rnd.choice( ZONES ),
+               'type':   rnd.choice( TYPES ),
+               'status': rnd.choice( STATUS ),
+               'size':   rnd.choice( SIZES ) if rnd.random() < 0.95 else None }
+                for n in xrange( count ) ]
+
+def aggregate( rows, options, chunk_size ):
+    ec2aggregate.CHUNK_SIZE = chunk_size
+    aggregator = Aggregator( parse_group_by( options.group_by, FIELDS ),
+                             parse_aggregates( options.agg, FIELDS ), FIELDS )
+    for row in rows:
+        aggregator.add( 'us-east-1', row )
+    return aggregator.rows()
+
+def timed( func, *args ):
+    start = time.time()
+    rv    = func( *args )
+    return time.time() - start, rv
+
+if __name__ == '__main__':
+    parser = OptionParser( "usage: %prog [options]" )
+    parser.add_option( "--count", default=100000, type="int",
+                       help="number of synthetic volumes" )
+    parser.add_option( "--repeat", default=3, type="int",
+                       help="runs per implementation, best one counts" )
+    parser.add_option( "--group-by", default='zone,type,tag:cost' )
+    parser.add_option( "--agg", default='count,sum(size),avg(size),min(size),max(size),'
+                                        'avg(tag:cost),max(tag:cost)' )
+
+    (options, args) = parser.parse_args()
+
+    rows  = synthetic_volumes( options.count )
+    numpy = ec2aggregate.numpy
+
+    print "%d volumes, --group-by %s --agg %s" % ( len( rows ), options.group_by, options.agg )
+
+    results = {}
+    for label, module in [ ( 'numpy', numpy ), ( 'fallback', None ) ]:
+        if label == 'numpy' and numpy is None:
+            print "%-10s not installed" % label
+            continue
+        ec2aggregate.numpy = module
+
+        ### and in small chunks, folding into columns that keep growing
+        results[ label ] = [ aggregate( rows, options, chunk_size )
+                                for chunk_size in ( 4096, 7 ) ]
+        best, groups = min( [ timed( aggregate, rows, options, 4096 )
+                                for _ in range( options.repeat ) ] )
+        print "%-10s %8.1f ms  %6d groups  %6.2f us/row" % (
+            label, best * 1000, len( groups ), best * 1e6 / len( rows ) )
+
+    ec2aggregate.numpy = numpy
+    mismatches = [ label for label, found in results.items()
+                    if found != [ results[ 'fallback' ][ 0 ] ] * 2 ]
+    if mismatches:
+        print "MISMATCH: %s disagree(s) with the fallback" % ', '.join( mismatches )
+        sys.exit( 1 )
+    print "ok: %s agree" % ', '.join( sorted( results ) )
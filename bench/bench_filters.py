@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark for the filter predicates in ec2filters.py, against the
+# per-resource regex dispatch instances.py used to do, over a synthetic
+# inventory.
+#
+#   ./bench/bench_filters.py [--count 100000] [-s running -t 'm5\..*' -N test]
+#
+import os
+import re
+import sys
+import time
+import random
+from operator   import itemgetter
+from optparse   import OptionParser
+
+sys.path.insert( 0, os.path.join( os.path.dirname( __file__ ), '..' ) )
+
+from ec2filters import compile_predicates, matches, tag
+
+TYPES   = [ 'm1.small', 'm3.large', 'm5.large', 'm5.2xlarge', 'c5.4xlarge', 'r5.xlarge' ]
+STATES  = [ 'running' ] * 8 + [ 'stopped', 'pending' ]
+ZONES   = [ 'us-east-1a', 'us-east-1b', 'us-east-1c', 'us-east-1d' ]
+ROLES   = [ 'web', 'api', 'db', 'cache', 'queue', 'test', 'batch' ]
+
+def synthetic_instances( count, seed=42 ):
+    """rows shaped like ec2inventory.instance_row()"""
+    rnd = random.Random( seed )
+    return [ { 'id':    'i-%08x' % n,
+               'tags':  { 'Name': '%s%03d.%s' % ( rnd.choice( ROLES ), n % 1000,
+                                                  rnd.choice( ZONES ) ) },
+               'type':  rnd.choice( TYPES ),
+               'zone':  rnd.choice( ZONES ),
+               'group': 'sg-%s' % rnd.choice( ROLES ),
+               'state': rnd.choice( STATES ) } for n in xrange( count ) ]
+
+def legacy_filter( rows, options ):
+    """the loop get_instances() used to run, for comparison"""
+    regexes = {}
+    for opt in [ 'group', 'exclude_group', 'name', 'exclude_name',
+                 'type',  'exclude_type',  'zone', 'exclude_zone',
+                 'state', 'exclude_state' ]:
+        if options.__dict__.get( opt, None ):
+            regexes[ opt ] = re.compile( options.__dict__.get( opt ), re.IGNORECASE )
+
+    rv = []
+    for i in rows:
+        wanted_node = True
+        for re_name, regex in regexes.iteritems():
+            if re.search( 'group', re_name ):
+                value = i['group']
+            elif re.search( 'name', re_name ):
+                value = i['tags'].get( 'Name', '' )
+            elif re.search( 'type', re_name ):
+                value = i['type']
+            elif re.search( 'state', re_name ):
+                value = i['state']
+            elif re.search( 'zone', re_name ):
+                value = i['zone']
+
+            rv_value = None if re.search( 'exclude', re_name ) else True
+            result   = regex.search( value )
+            if ( result is None ) != ( rv_value is None ):
+                wanted_node = False
+                break
+
+        if wanted_node:
+            rv.append( i )
+    return rv
+
+def compiled_filter( rows, options ):
+    predicates = compile_predicates( options, [
+        ( 'name',   tag( 'Name' ) ),
+        ( 'group',  itemgetter( 'group' ) ),
+        ( 'type',   itemgetter( 'type' ) ),
+        ( 'state',  itemgetter( 'state' ) ),
+        ( 'zone',   itemgetter( 'zone' ) ),
+    ])
+    return [ i for i in rows if matches( i, predicates ) ]
+
+def timed( func, *args ):
+    start = time.time()
+    rv    = func( *args )
+    return time.time() - start, rv
+
+if __name__ == '__main__':
+    parser = OptionParser( "usage: %prog [options]" )
+    parser.add_option( "--count", default=100000, type="int",
+                       help="number of synthetic instances" )
+    parser.add_option( "--repeat", default=3, type="int",
+                       help="runs per implementation, best one counts" )
+    for opt in [ 'group', 'name', 'type', 'zone', 'state' ]:
+        parser.add_option( "-" + opt[0], "--" + opt, default=None )
+        parser.add_option( "-" + opt[0].upper(), "--exclude-" + opt, default=None )
+    parser.set_defaults( state='running', type=r'm5\.', exclude_name='test' )
+
+    (options, args) = parser.parse_args()
+
+    rows = synthetic_instances( options.count )
+
+    print "%d instances, filters: %s" % ( len( rows ), ', '.join(
+        [ '%s=%s' % ( k, v ) for k, v in sorted( options.__dict__.items() )
+            if v and k not in ( 'count', 'repeat' ) ] ) )
+
+    for label, func in [ ( 'legacy', legacy_filter ), ( 'compiled', compiled_filter ) ]:
+        best, kept = min( [ timed( func, rows, options )
+                            for _ in range( options.repeat ) ] )
+        print "%-10s %8.1f ms  %6d kept  %6.2f us/row" % (
+            label, best * 1000, len( kept ), best * 1e6 / len( rows ) )
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+#
+# A fake EC2 backend for benchmarking: generates a synthetic account, and
+# swaps boto.ec2.connect_to_region() and boto.ec2.regions() for fakes that
+# answer describe calls from it, with a configurable latency per request.
+#
+# Run one of the tools against it:
+#
+#   ./bench/fakeec2.py --instances 10000 --volumes 20000 --latency 0.2 \
+#       instances.py --cache-ttl 0 -s running
+#
+# The tool's output goes where it always does; once it's done, a line like
+#   BENCH {"seconds": 1.23, "requests": 11, "throttled": 0}
+# is written to stderr.
+#
+# With --api-limit N, each region answers RequestLimitExceeded once it gets
+# more than N requests per second (after a burst of N), like EC2 does. The
+# answer is a 503 that goes through boto's own request loop, so boto's
+# retries (if left on) and exceptions are the real ones.
+#
+# With --churn N, N instances per region move on to their next state (see
+# LIFECYCLE) every second, e.g. to watch instances.py --watch at work.
+#
+import os
+import sys
+import json
+import time
+import random
+import re
+import fnmatch
+import threading
+from optparse import OptionParser
+
+import boto.ec2
+import boto.exception
+from boto.ec2.connection import EC2Connection
+from boto.regioninfo import RegionInfo
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+TYPES = ['m1.small', 'm3.large', 'm5.large', 'm5.2xlarge', 'c5.4xlarge', 'r5.xlarge']
+STATES = ['running'] * 17 + ['stopped', 'pending', 'stopping']
+ROLES = ['web', 'api', 'db', 'cache', 'queue', 'batch', 'puppetmaster']
+ENVIRONMENTS = ['production'] * 3 + ['staging', 'development']
+DEVICES = ['/dev/sdf', '/dev/sdg', '/dev/sdh']
+VOLUME_TYPES = ['gp2', 'gp2', 'io1', 'standard']
+PAGE_SIZE = 1000
+LIFECYCLE = {'pending': 'running', 'running': 'stopping', 'stopping': 'stopped',
+             'stopped': 'pending'}
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Page(list):
+    """a boto ResultSet stand-in"""
+    next_token = None
+
+
+def synthetic_account(region, instances, volumes, seed=42):
+    """
+    (instances, volumes) shaped like boto's objects, with realistic tags.
+    Volumes are attached to instances round robin, the rest are available.
+    """
+    rnd = random.Random('%s-%s' % (seed, region))
+    zones = ['%s%s' % (region, zone) for zone in 'abc']
+    # the same account all day, so separate runs sync without changes
+    today = int(time.time()) // 86400 * 86400
+
+    rv_instances = []
+    for n in xrange(instances):
+        role = rnd.choice(ROLES)
+        zone = rnd.choice(zones)
+        rv_instances.append(Obj(
+            id='i-%08x' % n,
+            tags={'Name': '%s%03d.%s.example.com' % (role, n % 1000, zone),
+                  'environment': rnd.choice(ENVIRONMENTS),
+                  'cluster_name': '%s-%d' % (role, n % 20),
+                  's_classes': 's_base,s_%s' % role},
+            instance_type=rnd.choice(TYPES), _placement=zone,
+            groups=[Obj(name='sg-%s' % role)], state=rnd.choice(STATES),
+            root_device_type='ebs',
+            launch_time=time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+                                      time.gmtime(today - rnd.randint(0, 86400 * 365))),
+            block_device_mapping={'/dev/sda1': Obj(volume_id='vol-r%07x' % n,
+                                                   delete_on_termination=True)}))
+
+    rv_volumes = []
+    for n in xrange(volumes):
+        attached = instances and n < instances * 2
+        instance = rv_instances[n % instances] if attached else None
+        device = DEVICES[n // instances % len(DEVICES)] if attached else None
+        if instance:
+            instance.block_device_mapping[device] = \
+                Obj(volume_id='vol-%08x' % n, delete_on_termination=False)
+        rv_volumes.append(Obj(
+            id='vol-%08x' % n,
+            tags={'Name': 'data%05d' % n},
+            zone=instance._placement if instance else rnd.choice(zones),
+            status='in-use' if instance else 'available',
+            size=rnd.choice([8, 50, 100, 500, 1000]), type=rnd.choice(VOLUME_TYPES),
+            create_time='2014-06-01T00:00:00.000Z',
+            attach_data=Obj(instance_id=instance and instance.id, device=device,
+                            status=instance and 'attached')))
+
+    return rv_instances, rv_volumes
+
+
+### what each filter name looks at
+INSTANCE_FIELDS = {
+    'instance-id':          lambda i: [i.id],
+    'instance-state-name':  lambda i: [i.state],
+    'instance-type':        lambda i: [i.instance_type],
+    'availability-zone':    lambda i: [i._placement],
+    'launch-time':          lambda i: [i.launch_time],
+    'tag-value':            lambda i: i.tags.values(),
+}
+VOLUME_FIELDS = {
+    'volume-id':            lambda v: [v.id],
+    'status':               lambda v: [v.status],
+    'availability-zone':    lambda v: [v.zone],
+    'attachment.device':    lambda v: [v.attach_data.device or ''],
+    'attachment.status':    lambda v: [v.attach_data.status or ''],
+    'create-time':          lambda v: [v.create_time],
+}
+
+
+def compile_filters(filters):
+    """
+    [(name, exact values, wildcard regexes)] for a filters= dict; exact
+    values are looked up in a set, as id filters come with hundreds of them.
+    """
+    rv = []
+    for name, values in (filters or {}).items():
+        if isinstance(values, basestring):
+            values = [values]
+        exact = set([value for value in values if not set('*?[') & set(value)])
+        wildcards = [re.compile(fnmatch.translate(value)) for value in values
+                     if value not in exact]
+        rv.append((name, exact, wildcards))
+    return rv
+
+
+def matches(obj, filters, fields):
+    """EC2 filter semantics: values OR'd, filters AND'd, '*' wildcards"""
+    for name, exact, wildcards in filters:
+        if name.startswith('tag:'):
+            have = [obj.tags.get(name[4:])]
+        else:
+            have = fields[name](obj)
+        if not [1 for h in have if h is not None and
+                (h in exact or [1 for regex in wildcards if regex.match(h)])]:
+            return False
+    return True
+
+
+class APILimit(object):
+    """EC2's request token bucket for one region: 'rate' per second, bursting to 'rate'"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+THROTTLED = ('<?xml version="1.0" encoding="UTF-8"?><Response><Errors><Error>'
+             '<Code>RequestLimitExceeded</Code><Message>Request limit exceeded.</Message>'
+             '</Error></Errors><RequestID>fake</RequestID></Response>')
+
+NOT_FOUND = ('<?xml version="1.0" encoding="UTF-8"?><Response><Errors><Error>'
+             '<Code>InvalidInstanceID.NotFound</Code><Message>The instance %s not exist'
+             '</Message></Error></Errors><RequestID>fake</RequestID></Response>')
+
+
+class FakeResponse(object):
+    """an httplib response, as far as boto's _mexe() looks at one"""
+
+    def __init__(self, status, reason, body=''):
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return default
+
+    def getheaders(self):
+        return []
+
+
+class FakeEndpoint(object):
+    """an httplib connection to a region: answers every request with 'answer()'"""
+    sock = None
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.response = None
+
+    def request(self, method, path, body=None, headers=None):
+        self.response = self.answer()
+
+    def getresponse(self):
+        return self.response
+
+    def close(self):
+        pass
+
+
+class FakeConnection(EC2Connection):
+    """
+    boto's EC2Connection, answering the calls our tools use from a synthetic
+    account. Every call still makes a request through boto's _mexe(), to a
+    fake endpoint, so num_retries and the exceptions work as they really do.
+    """
+
+    def __init__(self, region, account, latency, stats, limit=None):
+        EC2Connection.__init__(self, aws_access_key_id='fake', aws_secret_access_key='fake',
+                               region=RegionInfo(name=region,
+                                                 endpoint='ec2.%s.amazonaws.com' % region))
+        self.region_name = region
+        self.instances, self.volumes = account
+        self.latency = latency
+        self.stats = stats
+        self.limit = limit
+
+    def get_http_connection(self, host, port, is_secure):
+        return FakeEndpoint(self.answer)
+
+    def new_http_connection(self, host, port, is_secure):
+        return FakeEndpoint(self.answer)
+
+    def put_http_connection(self, host, port, is_secure, connection):
+        pass
+
+    def answer(self):
+        with self.stats['lock']:
+            self.stats['requests'] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.limit and not self.limit.allow():
+            with self.stats['lock']:
+                self.stats['throttled'] += 1
+            return FakeResponse(503, 'Service Unavailable', THROTTLED)
+        return FakeResponse(200, 'OK')
+
+    def request(self):
+        self.make_request('Fake').read()
+
+    def get_all_reservations(self, instance_ids=None, filters=None, dry_run=False,
+                             max_results=None, next_token=None):
+        self.request()
+        filters = compile_filters(filters)
+        wanted = [i for i in self.instances
+                  if matches(i, filters, INSTANCE_FIELDS)
+                  and (not instance_ids or i.id in instance_ids)]
+
+        start = int(next_token or 0)
+        end = start + max_results if max_results else len(wanted)
+        page = Page([Obj(instances=[i]) for i in wanted[start:end]])
+        if end < len(wanted):
+            page.next_token = str(end)
+        return page
+
+    def get_all_instances(self, instance_ids=None, filters=None, dry_run=False,
+                          max_results=None):
+        return self.get_all_reservations(instance_ids, filters, dry_run, max_results)
+
+    def get_all_volumes(self, volume_ids=None, filters=None, dry_run=False):
+        self.request()
+        filters = compile_filters(filters)
+        return [v for v in self.volumes
+                if matches(v, filters, VOLUME_FIELDS)
+                and (not volume_ids or v.id in volume_ids)]
+
+    def create_tags(self, resource_ids, tags, dry_run=False):
+        self.request()
+        known = set([i.id for i in self.instances])
+        missing = [r for r in resource_ids if r.startswith('i-') and r not in known]
+        if missing:
+            raise boto.exception.EC2ResponseError(400, 'Bad Request', NOT_FOUND % (
+                ("ID '%s' does" if len(missing) == 1 else "IDs '%s' do") % ', '.join(missing)))
+        return True
+
+
+def churn(accounts, count, seed=42):
+    """every second, move 'count' instances per region to their next state"""
+    rnd = random.Random(seed)
+    while True:
+        time.sleep(1)
+        for instances, volumes in accounts.values():
+            for i in rnd.sample(instances, min(count, len(instances))):
+                i.state = LIFECYCLE[i.state]
+
+
+def install(regions=('us-east-1',), instances=1000, volumes=1000, latency=0, api_limit=None,
+            churn_rate=0):
+    """
+    Patch boto.ec2 to talk to fake regions holding synthetic accounts.
+    Returns the stats dict, counting requests and throttled requests.
+    """
+    stats = {'requests': 0, 'throttled': 0, 'lock': threading.Lock()}
+    accounts = dict([(region, synthetic_account(region, instances, volumes))
+                     for region in regions])
+    limits = dict([(region, APILimit(api_limit) if api_limit else None)
+                   for region in regions])
+
+    if churn_rate:
+        thread = threading.Thread(target=churn, args=(accounts, churn_rate))
+        thread.daemon = True
+        thread.start()
+
+    def connect_to_region(region, **kwargs):
+        return FakeConnection(region, accounts.get(region, ([], [])), latency, stats,
+                              limits.get(region))
+
+    def fake_regions(**kwargs):
+        return [Obj(name=region, connect=lambda region=region: connect_to_region(region))
+                for region in regions]
+
+    boto.ec2.connect_to_region = connect_to_region
+    boto.ec2.regions = fake_regions
+    return stats
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options] script.py [script options]")
+    parser.disable_interspersed_args()
+    parser.add_option("--instances", type="int", default=1000,
+                      help='instances per region')
+    parser.add_option("--volumes", type="int", default=1000,
+                      help='volumes per region')
+    parser.add_option("--regions", default='us-east-1',
+                      help='comma-sep list of fake regions')
+    parser.add_option("--latency", type="float", default=0,
+                      help='seconds every request takes')
+    parser.add_option("--api-limit", type="float", default=None,
+                      help='requests per second per region, before getting throttled')
+    parser.add_option("--churn", type="int", default=0,
+                      help='instances per region changing state every second')
+    (options, args) = parser.parse_args()
+
+    stats = install(options.regions.split(','), options.instances, options.volumes,
+                    options.latency, options.api_limit, options.churn)
+
+    import runpy
+    script = os.path.join(ROOT, args[0]) if not os.path.exists(args[0]) else args[0]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    sys.argv = [script] + args[1:]
+
+    start = time.time()
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit:
+        pass
+    finally:
+        sys.stdout.flush()
+        sys.stderr.write("BENCH %s\n" % json.dumps({'seconds': time.time() - start,
+                                                   'requests': stats['requests'],
+                                                   'throttled': stats['throttled']}))
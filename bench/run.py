@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# Benchmark suite: times the tools against the fake EC2 backend
+# (fakeec2.py) and the fake ssh (fakessh), at a few account sizes, and
+# appends the results to a JSON lines file, tagged with the git version.
+# Each result is compared with the last one recorded for an older version,
+# so regressions stand out.
+#
+#   ./bench/run.py                          # 1k and 10k resources
+#   ./bench/run.py --sizes 1000,10000,100000 --only instances,volumes
+#
+# Benchmarks:
+#   instances   instances.py, tsv output, one region
+#   volumes     volumes.py -i, tsv output, one region
+#   search      search-ec2-tags.py over 8 regions, 8 at a time
+#   pssh        pssh.py fan out to --pssh-hosts hosts, through fakessh
+#   startup     instances.py and volumes.py --help, the mean of
+#               --startup-runs runs; what every invocation pays up front
+#
+# Every run gets an empty inventory cache of its own, so none of them
+# starts from what an earlier one left behind (or from a running daemon).
+#
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+FAKEEC2 = os.path.join(BENCH, 'fakeec2.py')
+FAKESSH = os.path.join(BENCH, 'fakessh')
+RESULTS = os.path.join(BENCH, 'results.jsonl')
+REGIONS = ['us-east-1', 'us-west-1', 'us-west-2', 'eu-west-1', 'eu-central-1',
+           'ap-southeast-1', 'ap-northeast-1', 'sa-east-1']
+REGRESSION = 1.2    # slower than this many times the last result is flagged
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_fakeec2(args, env):
+    """run a tool under fakeec2.py, return its BENCH stats"""
+    proc = subprocess.Popen([sys.executable, FAKEEC2] + args, cwd=ROOT, env=env,
+                            stdout=open(os.devnull, 'w'), stderr=subprocess.PIPE)
+    stderr = proc.communicate()[1]
+    for line in stderr.splitlines():
+        if line.startswith('BENCH '):
+            return json.loads(line[len('BENCH '):])
+    raise RuntimeError("no timing from %s:\n%s" % (args, stderr))
+
+
+def bench_instances(size, options, env):
+    return run_fakeec2(['--instances', str(size), '--volumes', '0',
+                        '--latency', str(options.latency),
+                        'instances.py', '--cache-ttl', '0', '-f', 'tsv'], env)
+
+
+def bench_volumes(size, options, env):
+    return run_fakeec2(['--instances', str(max(size // 2, 1)), '--volumes', str(size),
+                        '--latency', str(options.latency),
+                        'volumes.py', '--cache-ttl', '0', '-f', 'tsv', '-i'], env)
+
+
+def bench_search(size, options, env):
+    return run_fakeec2(['--instances', str(max(size // len(REGIONS), 1)), '--volumes', '0',
+                        '--regions', ','.join(REGIONS), '--latency', str(options.latency),
+                        'search-ec2-tags.py', '--cache-ttl', '0',
+                        '--parallel', str(len(REGIONS)), 'environment:production'], env)
+
+
+def bench_pssh(size, options, env):
+    hosts = ','.join(['host%05d' % n for n in range(size)])
+    start = time.time()
+    subprocess.check_call([sys.executable, os.path.join(ROOT, 'pssh.py'), '--no-color',
+                           '--ssh', FAKESSH, '--host', hosts, 'true'],
+                          cwd=ROOT, env=env, stdout=open(os.devnull, 'w'))
+    return {'seconds': time.time() - start, 'requests': 0}
+
+
+def bench_startup(size, options, env):
+    start = time.time()
+    for _ in range(size):
+        for tool in ('instances.py', 'volumes.py'):
+            subprocess.check_call([sys.executable, os.path.join(ROOT, tool), '--help'],
+                                  cwd=ROOT, env=env, stdout=open(os.devnull, 'w'))
+    return {'seconds': (time.time() - start) / (size * 2), 'requests': 0}
+
+
+BENCHMARKS = [('instances', bench_instances), ('volumes', bench_volumes),
+              ('search', bench_search), ('pssh', bench_pssh),
+              ('startup', bench_startup)]
+
+
+def previous_results(path, current):
+    """the last result per (bench, size) recorded for another version"""
+    rv = {}
+    if not os.path.exists(path):
+        return rv
+    with open(path) as fh:
+        for line in fh:
+            result = json.loads(line)
+            if result['version'] != current:
+                rv[(result['bench'], result['size'])] = result
+    return rv
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--sizes", default='1000,10000',
+                      help='comma-sep account sizes (resources) to benchmark')
+    parser.add_option("--pssh-hosts", default='100,500',
+                      help='comma-sep numbers of hosts for the pssh benchmark')
+    parser.add_option("--startup-runs", default='10',
+                      help='comma-sep numbers of runs to average the startup benchmark over')
+    parser.add_option("--latency", type="float", default=0.05,
+                      help='seconds every fake EC2 request takes')
+    parser.add_option("--only", default=None,
+                      help='comma-sep benchmarks to run: %s' % ', '.join(
+                          [name for name, func in BENCHMARKS]))
+    parser.add_option("--output", default=RESULTS,
+                      help='JSON lines file to append the results to')
+    (options, args) = parser.parse_args()
+
+    env = dict(os.environ)
+
+    current = version()
+    previous = previous_results(options.output, current)
+    only = options.only.split(',') if options.only else None
+
+    print "%-10s %8s %10s %9s  %s" % ('bench', 'size', 'seconds', 'requests', 'vs. last')
+    with open(options.output, 'a') as out:
+        for name, func in BENCHMARKS:
+            if only and name not in only:
+                continue
+
+            sizes = {'pssh': options.pssh_hosts,
+                     'startup': options.startup_runs}.get(name, options.sizes)
+            for size in [int(size) for size in sizes.split(',')]:
+                env['XDG_CACHE_HOME'] = tempfile.mkdtemp(prefix='bench-cache-')
+                try:
+                    stats = func(size, options, env)
+                finally:
+                    shutil.rmtree(env['XDG_CACHE_HOME'])
+                result = {'bench': name, 'size': size, 'seconds': round(stats['seconds'], 4),
+                          'requests': stats['requests'], 'latency': options.latency,
+                          'version': current, 'time': int(time.time())}
+                out.write(json.dumps(result, sort_keys=True) + '\n')
+
+                compared = ''
+                last = previous.get((name, size))
+                if last and last['seconds']:
+                    ratio = result['seconds'] / last['seconds']
+                    compared = '%.2fx %s' % (ratio, last['version'])
+                    if ratio > REGRESSION:
+                        compared += '  REGRESSION'
+
+                print "%-10s %8d %10.3f %9d  %s" % (name, size, result['seconds'],
+                                                   result['requests'], compared)
+                sys.stdout.flush()
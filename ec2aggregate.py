@@ -0,0 +1,290 @@
+#
+# --group-by / --agg for instances.py and volumes.py: the capacity questions
+# we used to answer by piping the table through sort | uniq -c | awk, in one
+# pass over the filtered resources, of any number of regions:
+#
+#   ./instances.py -r all -s running --group-by zone,type --agg count
+#   ./volumes.py --group-by zone,status --agg count,sum(size)
+#
+# Only the groups are kept, not the resources: every distinct group gets a
+# number, and every aggregate a column of per-group accumulators, which the
+# resources are folded into a chunk at a time (with numpy, if it's around,
+# and with array.array and a loop otherwise; bench/bench_aggregate.py checks
+# they agree).
+#
+# A resource without the field (no such tag, say) counts for count, but not
+# for the field's sum, avg, min or max; a group where none have it shows '-'.
+#
+import re
+from array import array
+
+import ec2stats
+from ec2output import writer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+AGGREGATES  = [ 'count', 'sum', 'avg', 'min', 'max' ]
+CHUNK_SIZE  = 4096      # resources to fold into the accumulators at a time
+SPEC        = re.compile( r'\s*(\w+)\s*(?:\(\s*([\w:.-]+)\s*\))?\s*(?:,|$)' )
+
+class AggregateError(Exception):
+    pass
+
+def parse_group_by( spec, fields ):
+    """'zone,type' -> [ 'zone', 'type' ], checked against 'fields'"""
+    names = [ name.strip() for name in spec.split( ',' ) if name.strip() ]
+    for name in names:
+        accessor( name, fields )
+    return names
+
+def parse_aggregates( spec, fields ):
+    """'count,sum(size)' -> [ ( 'count', None ), ( 'sum', 'size' ) ]"""
+    rv  = []
+    pos = 0
+    while pos < len( spec ):
+        match = SPEC.match( spec, pos )
+        if not match or match.end() == pos:
+            raise AggregateError( "can't parse --agg at '%s'" % spec[ pos: ] )
+        pos = match.end()
+
+        func, name = match.groups()
+        if func not in AGGREGATES:
+            raise AggregateError( "unknown aggregate '%s', pick from: %s" %
+                                  ( func, ', '.join( AGGREGATES ) ) )
+        if func == 'count' and name is not None:
+            raise AggregateError( "count takes no field: count, not count(%s)" % name )
+        if func != 'count' and name is None:
+            raise AggregateError( "%s needs a field, e.g. %s(size)" % ( func, func ) )
+        if name is not None:
+            accessor( name, fields )
+
+        rv.append( ( func, name ) )
+
+    if not rv:
+        raise AggregateError( "--agg needs at least one aggregate" )
+    return rv
+
+def accessor( name, fields ):
+    """function of ( region, row ) for a --group-by or --agg field: one of
+       'fields' (a dict of name -> function of the row), 'region', or
+       'tag:Key'."""
+    if name == 'region':
+        return lambda region, row: region
+    if name.startswith( 'tag:' ) and len( name ) > 4:
+        key = name[ 4: ]
+        return lambda region, row: row[ 'tags' ].get( key, '' )
+    if name in fields:
+        get = fields[ name ]
+        return lambda region, row: get( row )
+    raise AggregateError( "unknown field '%s', pick from: %s" %
+                          ( name, ', '.join( sorted( fields ) + [ 'region', 'tag:Key' ] ) ) )
+
+def label( func, name ):
+    return func if name is None else '%s(%s)' % ( func, name )
+
+class Aggregator(object):
+    """Folds ( region, row ) pairs into per-group aggregates. 'group_by' and
+       'aggregates' are what parse_group_by() and parse_aggregates()
+       return."""
+
+    def __init__( self, group_by, aggregates, fields ):
+        self.group_by   = group_by
+        self.aggregates = aggregates
+        self.keys       = [ accessor( name, fields ) for name in group_by ]
+
+        ### one column of input values per distinct field aggregated, and
+        ### one accumulator column per distinct ( aggregate, field ), and
+        ### per field, of the resources that have it; avg is sum / those
+        self.fields     = sorted( set( [ name for func, name in aggregates if name ] ) )
+        self.values     = [ accessor( name, fields ) for name in self.fields ]
+        self.wanted     = set( [ ( 'sum' if func == 'avg' else func, name )
+                                    for func, name in aggregates if name ] )
+
+        self.groups     = {}                    # key tuple -> group number
+        self.counts     = self.column( 0 )
+        self.columns    = dict( [ ( want, self.column( self.initial( want[ 0 ] ) ) )
+                                    for want in self.wanted ] )
+        self.present    = dict( [ ( name, self.column( 0 ) ) for name in self.fields ] )
+
+        ### the chunk being collected: group numbers, and per field, the
+        ### group numbers and values of the resources that have it
+        self.chunk      = array( 'l' )
+        self.chunk_values = self.new_chunk_values()
+
+    def new_chunk_values( self ):
+        return [ ( array( 'l' ), array( 'd' ) ) for name in self.fields ]
+
+    def initial( self, func ):
+        return { 'sum': 0, 'min': float( 'inf' ), 'max': float( '-inf' ) }[ func ]
+
+    def column( self, initial ):
+        if numpy is not None:
+            return numpy.zeros( 0 ) + initial
+        return array( 'd' )
+
+    def grow( self, column, size, initial ):
+        missing = size - len( column )
+        if numpy is not None:
+            return numpy.concatenate( [ column, numpy.zeros( missing ) + initial ] )
+        column.extend( [ initial ] * missing )
+        return column
+
+    def add( self, region, row ):
+        key     = tuple( [ get( region, row ) for get in self.keys ] )
+        group   = self.groups.get( key )
+        if group is None:
+            group = self.groups[ key ] = len( self.groups )
+
+        self.chunk.append( group )
+        for name, get, ( groups, values ) in zip( self.fields, self.values,
+                                                  self.chunk_values ):
+            value = get( region, row )
+            if value is None or value == '':
+                continue
+            try:
+                values.append( float( value ) )
+            except ValueError:
+                raise AggregateError( "'%s' isn't a number: %s" % ( name, value ) )
+            groups.append( group )
+
+        if len( self.chunk ) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush( self ):
+        """fold the chunk into the accumulators"""
+        size = len( self.groups )
+        self.counts = self.grow( self.counts, size, 0 )
+        for want in self.wanted:
+            self.columns[ want ] = self.grow( self.columns[ want ], size,
+                                              self.initial( want[ 0 ] ) )
+        for name in self.fields:
+            self.present[ name ] = self.grow( self.present[ name ], size, 0 )
+
+        if not self.chunk:
+            return
+        if numpy is not None:
+            self.fold_numpy( size )
+        else:
+            self.fold( size )
+
+        self.chunk = array( 'l' )
+        self.chunk_values = self.new_chunk_values()
+
+    def fold_numpy( self, size ):
+        groups = numpy.frombuffer( self.chunk, dtype=numpy.dtype( 'l' ) )
+        self.counts += numpy.bincount( groups, minlength=size )
+
+        ### frombuffer() of an empty chunk is an error
+        chunks = {}
+        for name, ( groups, values ) in zip( self.fields, self.chunk_values ):
+            if groups:
+                chunks[ name ] = ( numpy.frombuffer( groups, dtype=numpy.dtype( 'l' ) ),
+                                   numpy.frombuffer( values ) )
+        for name, ( groups, values ) in chunks.items():
+            self.present[ name ] += numpy.bincount( groups, minlength=size )
+
+        for ( func, name ), column in self.columns.items():
+            if name not in chunks:
+                continue
+            groups, values = chunks[ name ]
+            if func == 'sum':
+                column += numpy.bincount( groups, weights=values, minlength=size )
+            elif func == 'min':
+                numpy.minimum.at( column, groups, values )
+            else:
+                numpy.maximum.at( column, groups, values )
+
+    def fold( self, size ):
+        """fold_numpy(), without numpy"""
+        counts = self.counts
+        for group in self.chunk:
+            counts[ group ] += 1
+
+        for name, ( groups, values ) in zip( self.fields, self.chunk_values ):
+            present = self.present[ name ]
+            for group in groups:
+                present[ group ] += 1
+
+        for ( func, name ), column in self.columns.items():
+            groups, values = self.chunk_values[ self.fields.index( name ) ]
+            if func == 'sum':
+                for group, value in zip( groups, values ):
+                    column[ group ] += value
+            elif func == 'min':
+                for group, value in zip( groups, values ):
+                    if value < column[ group ]:
+                        column[ group ] = value
+            else:
+                for group, value in zip( groups, values ):
+                    if value > column[ group ]:
+                        column[ group ] = value
+
+    def output_columns( self ):
+        """( key, title, placeholder ) for ec2output.writer()"""
+        return [ ( name, name, '-' ) for name in self.group_by ] + \
+               [ ( label( func, name ), label( func, name ), '-' )
+                    for func, name in self.aggregates ]
+
+    def rows( self ):
+        """the groups, ordered by key, with their aggregates"""
+        self.flush()
+
+        rv = []
+        for key, group in sorted( self.groups.items() ):
+            count = int( self.counts[ group ] )
+            row   = list( key )
+            for func, name in self.aggregates:
+                if func == 'count':
+                    value = count
+                elif not self.present[ name ][ group ]:
+                    ### none of the group has it
+                    value = None
+                elif func == 'avg':
+                    value = round( self.columns[ ( 'sum', name ) ][ group ] /
+                                   self.present[ name ][ group ], 2 )
+                else:
+                    value = self.columns[ ( func, name ) ][ group ]
+                row.append( number( value ) )
+            rv.append( row )
+        return rv
+
+def number( value ):
+    """2 rather than 2.0"""
+    if value is None:
+        return None
+    value = float( value )
+    return int( value ) if value.is_integer() else value
+
+def grouping( options, fields, parser ):
+    """The Aggregator for the --group-by/--agg 'options' of a tool with
+       these AGG_FIELDS, None without them; 'parser' errors out on bad
+       ones."""
+    if not ( options.group_by or options.agg ):
+        return None
+
+    try:
+        return Aggregator( parse_group_by( options.group_by or '', fields ),
+                           parse_aggregates( options.agg or 'count', fields ),
+                           fields )
+    except AggregateError, e:
+        parser.error( str( e ) )
+
+def summarize( options, aggregator, pairs, parser ):
+    """Fold the ( region, row ) 'pairs' into 'aggregator', and show its
+       groups, rather than the resources themselves, in --format"""
+    out = writer( options.format, aggregator.output_columns(),
+                  header=not options.no_header )
+    add = ec2stats.timed( 'aggregate', aggregator.add )
+    try:
+        for region, row in pairs:
+            add( region, row )
+    except AggregateError, e:
+        parser.error( str( e ) )
+
+    with ec2stats.phase( 'render' ):
+        for row in aggregator.rows():
+            out.write( row )
+        out.close()
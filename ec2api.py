@@ -0,0 +1,199 @@
+#
+# Rate limiting and retries for EC2 API calls, shared by instances.py,
+# volumes.py, search-ec2-tags.py and update-ec2-tags.py.
+#
+# EC2 throttles per account and region, and all our threads (a multi-region
+# scan, batched lookups) share that. So every region gets one RegionLimiter
+# for the whole process:
+#
+#   * a token bucket, refilling at 'rate' requests per second, so a burst
+#     of calls is spread out rather than tripping the limit
+#   * a cap on the calls in flight at the same time
+#
+# Both adapt AIMD style: every success raises them a little, every
+# throttled call halves them. That keeps us close to whatever the account's
+# ceiling happens to be, without having to know it.
+#
+# A throttled call (or a 5xx) is retried, after a random wait of up to
+# 'backoff' seconds, doubling with every attempt ("full jitter"), so a pile
+# of throttled threads doesn't come back in lock step. boto's own retries
+# are off: they'd retry a throttled call (a 503) behind the limiter's back.
+#
+#   from ec2api import connect
+#   conn = connect('us-east-1')
+#   conn.get_all_volumes()      # rate limited, retried when throttled
+#
+# boto is only imported once there is something to connect to; it takes
+# longer to import than most of our tools take to answer from the cache.
+#
+import time
+import random
+import logging
+import threading
+
+import ec2stats
+
+# error codes EC2 uses to tell us to slow down
+THROTTLE_CODES = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
+
+INITIAL_RATE = 20       # requests per second; EC2's describe calls refill at ~20/s
+MAX_RATE = 100          # never go faster than this
+MIN_RATE = 1            # nor slower than this
+BURST = 50              # requests a region can make at once, after being idle
+INITIAL_CONCURRENCY = 4 # calls in flight per region
+MAX_CONCURRENCY = 32
+ATTEMPTS = 6            # tries per call, before giving up
+BACKOFF = 0.5           # seconds; the most to wait before the first retry
+MAX_BACKOFF = 20        # seconds; the most to wait before any retry
+
+
+class RegionLimiter(object):
+    """
+    The token bucket and concurrency cap of one region. Wrap every call in
+    acquire() and release(throttled).
+    """
+
+    def __init__(self, rate=INITIAL_RATE, burst=BURST, concurrency=INITIAL_CONCURRENCY):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.concurrency = float(concurrency)
+        self.in_flight = 0
+        self.throttled = 0      # throttled calls so far
+        self.cond = threading.Condition()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """wait for a token, and a free slot"""
+        with self.cond:
+            while True:
+                now = time.time()
+                self.refill(now)
+                if self.in_flight < int(self.concurrency) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+
+                if self.in_flight >= int(self.concurrency):
+                    # woken up by release()
+                    self.cond.wait(1)
+                else:
+                    self.cond.wait((1 - self.tokens) / self.rate)
+
+    def release(self, throttled=False):
+        with self.cond:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.rate = max(MIN_RATE, self.rate / 2)
+                self.concurrency = max(1, self.concurrency / 2)
+                # and nobody goes until the bucket refills at the new rate
+                self.tokens = min(self.tokens, 0)
+            else:
+                # about +1/s per second, and +1 slot per window of calls
+                self.rate = min(MAX_RATE, self.rate + 1 / self.rate)
+                self.concurrency = min(MAX_CONCURRENCY, self.concurrency + 1 / self.concurrency)
+            self.cond.notify_all()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(region):
+    """the RegionLimiter of 'region', shared by everybody in this process"""
+    with _limiters_lock:
+        if region not in _limiters:
+            _limiters[region] = RegionLimiter()
+        return _limiters[region]
+
+
+def retryable(error):
+    """(retry?, throttled?) for an EC2ResponseError, or a BotoServerError"""
+    if error.error_code in THROTTLE_CODES:
+        return True, True
+    return error.status >= 500, False
+
+
+def call(region, method, args=(), kwargs=None, attempts=ATTEMPTS, backoff=BACKOFF):
+    """
+    method(*args, **kwargs), rate limited by the region's RegionLimiter, and
+    retried when EC2 throttles us or has a hiccup. Gives up after 'attempts'
+    tries, raising the last EC2ResponseError.
+    """
+    from boto.exception import BotoServerError, EC2ResponseError
+
+    bucket = limiter(region)
+
+    for attempt in range(attempts):
+        bucket.acquire()
+        throttled = False
+        try:
+            return method(*args, **(kwargs or {}))
+        except BotoServerError, e:
+            # a 5xx (throttled, too) comes out of boto's request loop as
+            # a BotoServerError, anything else as an EC2ResponseError
+            retry, throttled = retryable(e)
+            if not retry or attempt == attempts - 1:
+                if isinstance(e, EC2ResponseError):
+                    raise
+                raise EC2ResponseError(e.status, e.reason, e.body)
+        finally:
+            bucket.release(throttled)
+
+        if throttled:
+            ec2stats.count(region, 'throttled')
+        ec2stats.count(region, 'retries')
+
+        wait = random.uniform(0, min(MAX_BACKOFF, backoff * 2 ** attempt))
+        logging.debug("%s: %s, retrying in %.1fs (now at %.1f requests/s)" %
+                      (region, e.error_code, wait, bucket.rate))
+        time.sleep(wait)
+
+
+def limited(conn, region, attempts=ATTEMPTS, backoff=BACKOFF):
+    """
+    Route the API calls of a boto EC2 connection through call(). Returns
+    'conn'.
+    """
+    # boto's get_all_instances() is get_all_reservations() under the hood;
+    # a second token (or slot) for the inner call could deadlock
+    calling = threading.local()
+
+    def wrap(method):
+        def wrapper(*args, **kwargs):
+            if getattr(calling, 'busy', False):
+                return method(*args, **kwargs)
+
+            calling.busy = True
+            try:
+                return call(region, method, args, kwargs, attempts, backoff)
+            finally:
+                calling.busy = False
+        return wrapper
+
+    for name in ec2stats.API_CALLS:
+        if hasattr(conn, name):
+            setattr(conn, name, wrap(getattr(conn, name)))
+    return conn
+
+
+def connect(region, attempts=ATTEMPTS, backoff=BACKOFF):
+    """
+    boto.ec2.connect_to_region(region), rate limited and retried (and with
+    --stats, instrumented). Like boto's, these aren't thread safe; make one
+    per thread. Raises ValueError for a region boto doesn't know.
+    """
+    with ec2stats.phase('connect'):
+        import boto.ec2
+        conn = boto.ec2.connect_to_region(region)
+    if conn is None:
+        raise ValueError("unknown region %s" % region)
+    # we do the retrying, see call() (a num_retries in the boto config
+    # still overrides this)
+    conn.num_retries = 0
+    return limited(ec2stats.instrument(conn, region), region, attempts, backoff)
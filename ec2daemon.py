@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+#
+# Inventory daemon: keeps a connection per region open, and every instance
+# and volume in memory, and answers instances.py, volumes.py,
+# search-ec2-tags.py and pssh.py --query over a Unix socket. They use it
+# when it's running, and its data is no older than their --cache-ttl, and
+# talk to EC2 themselves otherwise.
+#
+# Each region is fetched in full, every --interval seconds: a delta sync
+# (see ec2sync.py) misses tag edits and volume attachments, while the tools
+# take the data to be as fresh as its last sync. The daemon doesn't write
+# the synced snapshot that the tools' --sync and tag index use.
+#
+#   ./ec2daemon.py --region all &
+#   ./ec2daemon.py --status
+#
+# The protocol is a JSON request on one line, answered with a JSON header
+# line ({"error": ...} if it can't help), followed by one JSON line per row
+# for "rows":
+#
+#   {"op": "rows", "kind": "instances", "region": "us-east-1", "max_age": 60}
+#   {"op": "names", "region": "us-east-1", "ids": [...], "max_age": 60}
+#   {"op": "search", "query": ["Name:web", "OR", "db"], "regions": null, "max_age": 60}
+#   {"op": "status"}
+#
+# "regions": null means all regions; only a daemon started with --region
+# all can answer that.
+#
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import socket
+import logging
+import threading
+
+from ec2inventory import CACHE_PATH, InventoryCache, region_names, jsonable
+from ec2sync import InventorySync, INSTANCES, VOLUMES
+
+SOCKET_PATH = os.path.join(os.path.dirname(CACHE_PATH), 'inventoryd.sock')
+REFRESH_INTERVAL = 60   # seconds between syncs of a region
+TIMEOUT = 10            # seconds the client waits on the daemon
+
+
+class Client(object):
+    """
+    Talks to the daemon. Every method returns None when there's no daemon,
+    or it can't answer (stale data, a region it doesn't know), so callers
+    can fall back to asking EC2.
+    """
+
+    def __init__(self, path=SOCKET_PATH, timeout=TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+
+    def call(self, request):
+        """send 'request', return (header, file to read the rest from) or None"""
+        # no daemon: don't even bother with a socket
+        if not os.path.exists(self.path):
+            return None
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        fh = header = None
+        try:
+            sock.connect(self.path)
+            sock.sendall(json.dumps(request) + '\n')
+            fh = sock.makefile('r')
+            header = json.loads(fh.readline() or 'null')
+        except (socket.error, ValueError), e:
+            logging.debug("inventory daemon unavailable: %s" % e)
+            return None
+        finally:
+            # fh keeps the connection open for the rows, if there are any
+            sock.close()
+            if fh is not None and (not header or header.get('error')):
+                fh.close()
+
+        if not header or header.get('error'):
+            logging.debug("inventory daemon can't help: %s" % (header or {}).get('error'))
+            return None
+        return header, fh
+
+    def rows(self, kind, region, max_age):
+        """the rows of 'kind' ('instances', 'volumes') in 'region'"""
+        answer = self.call({'op': 'rows', 'kind': kind, 'region': region,
+                            'max_age': max_age})
+        if answer is None:
+            return None
+        header, fh = answer
+        return self._rows(header['count'], fh)
+
+    def _rows(self, count, fh):
+        try:
+            for _ in xrange(count):
+                yield json.loads(fh.readline())
+        finally:
+            fh.close()
+
+    def names(self, region, ids, max_age):
+        """a dict of instance id -> Name tag (the id if untagged) for 'ids'"""
+        answer = self.call({'op': 'names', 'region': region, 'ids': list(ids),
+                            'max_age': max_age})
+        if answer is None:
+            return None
+        answer[1].close()
+        return answer[0]['names']
+
+    def search(self, args, regions, max_age):
+        """
+        A dict of region -> hostnames matching the ec2index query 'args', in
+        'regions' (names, None for all of them).
+        """
+        answer = self.call({'op': 'search', 'query': args, 'regions': regions,
+                            'max_age': max_age})
+        if answer is None:
+            return None
+        answer[1].close()
+        return answer[0]['regions']
+
+    def status(self):
+        answer = self.call({'op': 'status'})
+        if answer is None:
+            return None
+        answer[1].close()
+        return answer[0]
+
+
+class RegionInventory(object):
+    """
+    Everything the daemon knows about one region, replaced wholesale by
+    every refresh, so requests never see half of one.
+    """
+
+    def __init__(self, region, cache):
+        self.region = region
+        self.syncs = [InventorySync(cache, region, kind, store=False)
+                      for kind in (INSTANCES, VOLUMES)]
+        self.rows = {}          # kind -> rows, sorted by id
+        self.by_id = {}         # kind -> id -> row
+        self.synced_at = {}     # kind -> time
+        self.index = None       # ec2index.TagIndex of the instances
+        self.error = None
+
+    def refresh(self, conn):
+        # only the daemon pays for boto
+        from ec2index import TagIndex
+
+        for sync in self.syncs:
+            # the rows are as old as the sync's start, not its end
+            started = time.time()
+            rows, changes = sync.sync(conn, full=True)
+            logging.info("%s %s: %s" % (self.region, sync.kind.name, changes))
+
+            ordered = [rows[id] for id in sorted(rows)]
+            index = TagIndex(rows) if sync.kind.name == 'instances' else None
+            # swap in the new state in one go
+            self.rows[sync.kind.name] = ordered
+            self.by_id[sync.kind.name] = rows
+            self.synced_at[sync.kind.name] = started
+            if index:
+                self.index = index
+
+    def fresh(self, kind, max_age):
+        synced_at = self.synced_at.get(kind)
+        return synced_at is not None and time.time() - synced_at <= max_age
+
+
+class InventoryDaemon(object):
+
+    def __init__(self, regions, all_regions, interval=REFRESH_INTERVAL):
+        self.cache = InventoryCache()
+        self.interval = interval
+        self.all_regions = all_regions
+        self.started = time.time()
+        self.inventories = dict([(region, RegionInventory(region, self.cache))
+                                 for region in regions])
+
+    def refresher(self, inventory):
+        """
+        Keep a region up to date, over one warm connection: no older than
+        the interval, as long as a sync takes less than half of it.
+        """
+        from ec2api import connect
+
+        conn = None
+        while True:
+            started = time.time()
+            try:
+                if conn is None:
+                    conn = connect(inventory.region)
+                inventory.refresh(conn)
+                inventory.error = None
+            except Exception, e:
+                logging.error("%s: %s" % (inventory.region, e))
+                inventory.error = str(e)
+                # start over with a new connection
+                conn = None
+
+            # the next sync has to be done before this one's rows are
+            # 'interval' old, and will likely take as long as this one
+            took = time.time() - started
+            time.sleep(max(self.interval - 2 * took, 0))
+
+    def start(self):
+        for inventory in self.inventories.values():
+            thread = threading.Thread(target=self.refresher, args=(inventory,))
+            thread.daemon = True
+            thread.start()
+
+    def inventory(self, region, kind, max_age):
+        """the region's RegionInventory, if it has recent enough 'kind'"""
+        inventory = self.inventories.get(region)
+        if inventory is None:
+            raise LookupError("not serving %s" % region)
+        if not inventory.fresh(kind, max_age):
+            raise LookupError("%s %s older than %ss" % (region, kind, max_age))
+        return inventory
+
+    def answer(self, request, out):
+        """write the answer to 'request' to the file 'out'"""
+        op = request.get('op')
+        max_age = request.get('max_age', self.interval * 2)
+
+        if op == 'rows':
+            rows = self.inventory(request['region'], request['kind'], max_age) \
+                .rows[request['kind']]
+            out.write(json.dumps({'count': len(rows)}) + '\n')
+            for row in rows:
+                out.write(json.dumps(row, default=jsonable) + '\n')
+
+        elif op == 'names':
+            instances = self.inventory(request['region'], 'instances', max_age) \
+                .by_id['instances']
+            names = dict([(id, instances[id]['tags'].get('Name', id))
+                          for id in request['ids'] if id in instances])
+            out.write(json.dumps({'names': names}) + '\n')
+
+        elif op == 'search':
+            from ec2index import parse
+
+            regions = request.get('regions')
+            if regions is None:
+                if not self.all_regions:
+                    raise LookupError("not serving all regions")
+                regions = self.inventories.keys()
+
+            query = parse(request['query'])
+            answers = {}
+            for region in regions:
+                index = self.inventory(region, 'instances', max_age).index
+                answers[region] = index.names(index.evaluate(query))
+            out.write(json.dumps({'regions': answers}) + '\n')
+
+        elif op == 'status':
+            out.write(json.dumps({
+                'pid': os.getpid(),
+                'uptime': time.time() - self.started,
+                'regions': dict([(region, {'synced_at': inventory.synced_at,
+                                           'error': inventory.error,
+                                           'counts': dict([(kind, len(rows)) for kind, rows
+                                                           in inventory.rows.items()])})
+                                 for region, inventory in self.inventories.items()]),
+            }) + '\n')
+
+        else:
+            raise LookupError("unknown op %r" % op)
+
+    def serve(self, path=SOCKET_PATH):
+        import SocketServer
+
+        daemon = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                # nothing to answer: somebody checking we're alive, see claim_socket()
+                if not line:
+                    return
+                try:
+                    daemon.answer(json.loads(line), self.wfile)
+                except socket.error:
+                    pass
+                except Exception, e:
+                    self.wfile.write(json.dumps({'error': str(e)}) + '\n')
+
+            def finish(self):
+                try:
+                    SocketServer.StreamRequestHandler.finish(self)
+                except socket.error:
+                    pass    # the client went away
+
+        class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+            daemon_threads = True
+
+        claim_socket(path)
+        # the inventory is nobody else's business
+        umask = os.umask(077)
+        try:
+            server = Server(path, Handler)
+        finally:
+            os.umask(umask)
+
+        logging.info("serving %s on %s" % (', '.join(sorted(self.inventories)), path))
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
+
+
+def claim_socket(path):
+    """remove a socket left behind by a dead daemon; refuse to replace a live one"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if not os.path.exists(path):
+        return
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error, e:
+        if e.args[0] not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+        os.unlink(path)
+    else:
+        sys.exit("another daemon is already serving %s" % path)
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-r", "--region", default='all',
+                      help="ec2 region(s) to serve: comma-sep, or 'all'")
+    parser.add_option("--interval", type="int", default=REFRESH_INTERVAL,
+                      help='seconds between syncs of every region')
+    parser.add_option("--socket", default=SOCKET_PATH,
+                      help='the Unix socket to listen on')
+    parser.add_option("--status", action="store_true", default=False,
+                      help="show what the running daemon has, and exit")
+    parser.add_option("-v", "--verbose", action="store_true", default=False,
+                      help='enable debug output')
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, format='%(asctime)s %(message)s',
+                        level=logging.DEBUG if options.verbose else logging.INFO)
+
+    if options.status:
+        status = Client(options.socket).status()
+        if status is None:
+            sys.exit("no daemon on %s" % options.socket)
+        print json.dumps(status, indent=2, sort_keys=True)
+        sys.exit(0)
+
+    # exit through serve()'s cleanup, so the socket goes away with us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    daemon = InventoryDaemon(region_names(options.region), options.region == 'all',
+                             options.interval)
+    daemon.start()
+    daemon.serve(options.socket)
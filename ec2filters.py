@@ -0,0 +1,98 @@
+#
+# Filter helpers shared by instances.py and volumes.py.
+#
+# The include options (--state, --type, --zone, ...) are regexes, matched
+# client side. Most of the time though they are a plain word, or a few words
+# joined by '|', and those can be handed to the EC2 API as a server side
+# filter instead, so we don't download the resources we'd throw away anyway.
+# The regexes still run on whatever comes back.
+#
+import re
+
+### a plain literal, optionally anchored: only characters that mean
+### themselves in a regex. '.' is let through as well, as instance types are
+### written like 'm1.small', and nobody means 'any character' there.
+LITERAL = re.compile( r'^(\^?)([\w.\-/:]+)(\$?)$' )
+
+### what a literal may hold for a case sensitive field (tags): with letters
+### the IGNORECASE regex matches more than the filter would ('web' vs.
+### 'Web01'), and so does a '.' meaning any character ('foo.bar')
+CASELESS = re.compile( r'^[^a-zA-Z.]*$' )
+
+def literal_values( pattern, lower=False ):
+    """Translate a regex that is a literal, or an alternation of literals,
+       into a list of EC2 filter values ('*' wildcards for unanchored ends).
+       Returns None if the regex is anything more complicated than that.
+
+       EC2 filters are case sensitive, our regexes are not. Pass lower=True
+       for fields whose values are always lower case (states, types, zones,
+       devices); for anything else, only literals without letters (or '.')
+       are sent, as the filter would drop resources the regex matches."""
+    values = []
+    for alt in pattern.split( '|' ):
+        match = LITERAL.match( alt )
+        if not match:
+            return None
+
+        start, literal, end = match.groups()
+        if not lower and not CASELESS.match( literal ):
+            return None
+        if lower:
+            literal = literal.lower()
+
+        values.append( ( '' if start else '*' ) + literal + ( '' if end else '*' ) )
+
+    return values
+
+def server_filters( options, mapping ):
+    """Build the filters= dict for a describe call. 'mapping' is a dict of
+       option name -> ( EC2 filter name, lower case values? ). Options that
+       aren't set, or aren't simple literals, are left to the regexes."""
+    filters = {}
+    for opt, ( name, lower ) in mapping.items():
+        pattern = options.__dict__.get( opt, None )
+        if not pattern:
+            continue
+
+        values = literal_values( pattern, lower )
+        if values:
+            filters[ name ] = values
+
+    return filters
+
+###################
+### Predicates
+###################
+
+### The include/exclude options, compiled once into a flat list of
+### ( field accessor, regex, should it match? ) tuples, so checking a
+### resource is one regex search per filter, and stops at the first miss.
+
+def compile_predicates( options, fields ):
+    """'fields' is a list of ( option name, accessor ), with accessor a
+       function returning the value to match from a row. List the fields
+       most selective first (a --name usually narrows things down more than
+       a --zone); includes go before excludes, as they reject more rows."""
+    includes = []
+    excludes = []
+    for field, accessor in fields:
+        pattern = options.__dict__.get( field, None )
+        if pattern:
+            includes.append( ( accessor, re.compile( pattern, re.IGNORECASE ), True ) )
+
+        pattern = options.__dict__.get( 'exclude_' + field, None )
+        if pattern:
+            excludes.append( ( accessor, re.compile( pattern, re.IGNORECASE ), False ) )
+
+    return includes + excludes
+
+def matches( row, predicates ):
+    """True if the row passes every predicate"""
+    for accessor, regex, wanted in predicates:
+        if ( regex.search( accessor( row ) ) is not None ) != wanted:
+            return False
+    return True
+
+def tag( name ):
+    """accessor for a tag, '' if it's not set"""
+    return lambda row: row[ 'tags' ].get( name, '' )
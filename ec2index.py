@@ -0,0 +1,264 @@
+#
+# Local tag search for search-ec2-tags.py: an inverted index over the synced
+# instance snapshot (see ec2sync.py), so a query is a few set operations
+# instead of an API pass over every region, and can be any boolean
+# expression rather than what EC2's filters can express.
+#
+# Queries use the search-ec2-tags.py terms, 'key:value' (the tag 'key'
+# contains 'value') and 'value' (any tag contains it), combined with AND,
+# OR, NOT and parentheses. Terms next to each other are AND'd:
+#
+#   s_classes:s_puppetmaster AND (production OR development)
+#   Name:web NOT environment:staging
+#
+# A query without any operators means what it always meant (see
+# legacy_query()), so existing invocations keep their results: every
+# argument is one filter, spaces and all, and no arguments match every
+# instance. A query is taken as an expression as soon as one of its words
+# is AND, OR or NOT, or it has a parenthesis in it; to look for a value
+# like that, use search-ec2-tags.py --api.
+#
+# Like the API, matching is case sensitive, and values can have the API's
+# wildcards: * for any characters, ? for any one, \ to escape them.
+#
+import re
+import time
+
+import ec2stats
+from ec2api import connect
+from ec2sync import InventorySync, INSTANCES, SYNC_KEY
+
+OPERATORS = ['AND', 'OR', 'NOT', '(', ')']
+TOKENS = re.compile(r'\(|\)|[^\s()]+')
+
+
+class QueryError(Exception):
+    pass
+
+
+def trigrams(string):
+    return set([string[idx:idx + 3] for idx in range(len(string) - 2)])
+
+
+def wildcards(string):
+    """
+    (regex, literal parts) for a value with the API's wildcards in it, the
+    regex finding it anywhere in a tag value; None for one without any.
+    """
+    if not [char for char in '*?\\' if char in string]:
+        return None
+
+    regex = []
+    literals = ['']
+    idx = 0
+    while idx < len(string):
+        char = string[idx]
+        if char in '*?':
+            regex.append('.*' if char == '*' else '.')
+            literals.append('')
+        else:
+            if char == '\\' and idx + 1 < len(string):
+                idx += 1
+                char = string[idx]
+            regex.append(re.escape(char))
+            literals[-1] += char
+        idx += 1
+    return re.compile(''.join(regex), re.S), [literal for literal in literals if literal]
+
+
+class TagIndex(object):
+    """
+    Instance ids by tag key and value, and the distinct tag values by
+    trigram, for the substring matches. Built from a dict of id -> row.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.ids = set(rows)
+        self.by_tag = {}        # key -> value -> set of ids
+        self.by_value = {}      # value -> set of ids, whatever the key
+        self.by_trigram = {}    # trigram -> set of values
+
+        for id, row in rows.items():
+            for key, value in row['tags'].items():
+                self.by_tag.setdefault(key, {}).setdefault(value, set()).add(id)
+                self.by_value.setdefault(value, set()).add(id)
+
+        for value in self.by_value:
+            for trigram in trigrams(value):
+                self.by_trigram.setdefault(trigram, set()).add(value)
+
+    def values_containing(self, string):
+        """the distinct tag values that contain 'string' (see wildcards())"""
+        pattern = wildcards(string)
+        if pattern is None:
+            contains, literals = lambda value: string in value, [string]
+        else:
+            contains, literals = pattern[0].search, pattern[1]
+
+        wanted = set()
+        for literal in literals:
+            wanted |= trigrams(literal)
+        if not wanted:
+            # too short to narrow down, look at all of them
+            return [value for value in self.by_value if contains(value)]
+
+        candidates = None
+        for trigram in sorted(wanted, key=lambda t: len(self.by_trigram.get(t, ()))):
+            found = self.by_trigram.get(trigram)
+            if not found:
+                return []
+            candidates = found if candidates is None else candidates & found
+        # all trigrams present doesn't mean they're in the right order
+        return [value for value in candidates if contains(value)]
+
+    def lookup(self, key, string):
+        """the ids whose tag 'key' (None: any tag) contains 'string'"""
+        values = self.by_tag.get(key, {}) if key is not None else self.by_value
+        rv = set()
+        for value in self.values_containing(string):
+            rv |= values.get(value, set())
+        return rv
+
+    def evaluate(self, query):
+        """the set of ids matching a parse()d query"""
+        op = query[0]
+        if op == 'tag':
+            return self.lookup(query[1], query[2])
+        if op == 'not':
+            return self.ids - self.evaluate(query[1])
+        if op == 'and':
+            if len(query) == 1:
+                # nothing to match, like an API call without filters
+                return set(self.ids)
+            rv = self.evaluate(query[1])
+            for sub in query[2:]:
+                if not rv:
+                    break
+                rv = rv & self.evaluate(sub)
+            return rv
+        if op == 'or':
+            rv = set()
+            for sub in query[1:]:
+                rv |= self.evaluate(sub)
+            return rv
+        raise QueryError("unknown operator %r" % op)
+
+    def names(self, ids):
+        """the Name tags of these ids, None for untagged ones"""
+        return [self.rows[id]['tags'].get('Name') for id in sorted(ids)]
+
+
+def term(string):
+    """('tag', key, value) for 'key:value', ('tag', None, value) for 'value'"""
+    parts = string.split(':', 1)
+    if len(parts) == 2:
+        return ('tag', parts[0], parts[1])
+    return ('tag', None, parts[0])
+
+
+def legacy_query(args):
+    """
+    The query search-ec2-tags.py always ran: terms for the same tag are
+    OR'd, and those groups (plain values being one group) are AND'd. See
+    ec2search.build_query(). No args at all match everything.
+    """
+    groups = {}
+    order = []
+    for arg in args:
+        tag = term(arg)
+        if tag[1] not in groups:
+            order.append(tag[1])
+        groups.setdefault(tag[1], []).append(tag)
+    return ('and',) + tuple([('or',) + tuple(groups[key]) for key in order])
+
+
+def parse(args):
+    """
+    The query in the command line 'args', as nested tuples: ('and', ...),
+    ('or', ...), ('not', q) and ('tag', key or None, value).
+    """
+    tokens = []
+    for arg in args:
+        tokens.extend(TOKENS.findall(arg))
+
+    if not [token for token in tokens if token in OPERATORS]:
+        # each argument is a filter, whatever is in it
+        return legacy_query(args)
+
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def take():
+        pos[0] += 1
+        return tokens[pos[0] - 1]
+
+    def expr():
+        rv = [conjunction()]
+        while peek() == 'OR':
+            take()
+            rv.append(conjunction())
+        return rv[0] if len(rv) == 1 else ('or',) + tuple(rv)
+
+    def conjunction():
+        rv = [factor()]
+        while peek() not in (None, 'OR', ')'):
+            if peek() == 'AND':
+                take()
+            rv.append(factor())
+        return rv[0] if len(rv) == 1 else ('and',) + tuple(rv)
+
+    def factor():
+        token = peek()
+        if token is None:
+            raise QueryError("query ends too early")
+        take()
+        if token == 'NOT':
+            return ('not', factor())
+        if token == '(':
+            rv = expr()
+            if peek() != ')':
+                raise QueryError("missing )")
+            take()
+            return rv
+        if token in OPERATORS:
+            raise QueryError("unexpected %s" % token)
+        return term(token)
+
+    rv = expr()
+    if peek() is not None:
+        raise QueryError("unexpected %s" % peek())
+    return rv
+
+
+def region_index(region, cache, refresh=False):
+    """
+    The TagIndex of a region's instances, from its synced snapshot, unless
+    that is older than the cache TTL, or 'refresh': then from a full sync.
+    Not a delta sync: that doesn't see tag edits (see ec2sync.py), and tags
+    are what a search is about.
+    """
+    snapshot = cache.load(region, INSTANCES.name, SYNC_KEY)
+    if snapshot and not refresh and time.time() - snapshot[0] <= cache.ttl:
+        return TagIndex(snapshot[1]['rows'])
+
+    rows, changes = InventorySync(cache, region, INSTANCES).sync(connect(region),
+                                                                   full=True)
+    return TagIndex(rows)
+
+
+def search_region(region, query, cache=None, refresh=False):
+    """
+    Like ec2search.search_region(), but 'query' is a parse()d query, run
+    against the region's TagIndex.
+    """
+    with ec2stats.phase('index'):
+        index = region_index(region.name, cache, refresh)
+    with ec2stats.phase('query'):
+        ids = index.evaluate(query)
+
+    ec2stats.count(region.name, 'scanned', len(index.ids))
+    ec2stats.count(region.name, 'kept', len(ids))
+    return index.names(ids)
@@ -0,0 +1,404 @@
+#
+# Local inventory cache, shared by instances.py, volumes.py and
+# search-ec2-tags.py.
+#
+# Describe calls are slow, and operators run these tools over and over while
+# debugging. Results are stored per (region, resource type, query) in a SQLite
+# database under ~/.cache, and reused until they are older than the TTL.
+#
+# Every snapshot is written in a single transaction, so a concurrent run
+# either sees the previous snapshot or the new one, never half of it.
+#
+# Rows are projected off the boto objects as they are parsed (see
+# instance_row / volume_row), into records that hold only the fields our
+# tools use, and the boto objects are dropped right away. The strings rows
+# share (tag keys and values, zones, types, states; not Name tags) are
+# interned, up to INTERN_LIMIT of them. Rows read like the dicts they go
+# through the cache (and the daemon) as.
+#
+import os
+import time
+import json
+import sqlite3
+import logging
+import threading
+import Queue
+
+CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                          'aws-analysis-tools', 'inventory.sqlite')
+DEFAULT_TTL = 60        # seconds a snapshot is considered fresh
+PURGE_AFTER = 86400     # drop snapshots nobody asked for in a day
+PAGE_SIZE = 1000        # instances per describe call
+DEFAULT_WORKERS = 8     # regions to fetch at the same time
+ROW_BATCH = 500         # rows a region worker hands over at a time
+INTERN_LIMIT = 100000   # distinct strings to share, before starting over
+UNIQUE_TAGS = ('Name',) # tags with a value of their own on every resource
+
+
+_strings = {}
+
+
+def interned(string):
+    """
+    The one copy of 'string' every row shares; a fleet has thousands of
+    instances, but only a handful of zones, types and tag values. Values
+    keep coming as instances come and go (in the daemon, or --watch), so
+    once there are INTERN_LIMIT of them, we start over: rows made since
+    share new copies, and the old ones go with their rows.
+    """
+    if string is None:
+        return None
+    rv = _strings.get(string)
+    if rv is None:
+        if len(_strings) >= INTERN_LIMIT:
+            _strings.clear()
+        rv = _strings[string] = string
+    return rv
+
+
+class Row(object):
+    """
+    A resource, as our tools see it: only the fields in __slots__, with
+    INTERNED ones (and the tag keys and values) interned. Reads like a
+    dict (row['id'], row.get('tags'), dict(row)); see jsonable() for
+    json.dumps().
+    """
+
+    __slots__ = ()
+    INTERNED = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            value = fields.get(name)
+            if name == 'tags':
+                value = dict([(interned(key), val if key in UNIQUE_TAGS else interned(val))
+                              for key, val in (value or {}).items()])
+            elif name in self.INTERNED:
+                value = interned(value)
+            setattr(self, name, value)
+
+    @classmethod
+    def from_dict(cls, data):
+        """a row from its dict form, e.g. out of the cache"""
+        return cls(**dict([(str(key), value) for key, value in data.items()]))
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def get(self, name, default=None):
+        if name not in self.__slots__:
+            return default
+        return getattr(self, name)
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def as_dict(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__])
+
+    def __eq__(self, other):
+        if isinstance(other, Row):
+            other = other.as_dict()
+        return self.as_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    # like a dict, it changes
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.as_dict())
+
+
+class InstanceRow(Row):
+    __slots__ = ('id', 'tags', 'type', 'zone', 'group', 'state', 'root_device_type',
+                 'launch_time', 'block_devices')
+    INTERNED = ('type', 'zone', 'group', 'state', 'root_device_type')
+
+    def __init__(self, **fields):
+        Row.__init__(self, **fields)
+        # (device, volume id, delete on termination); tuples, as they're
+        # never changed, and smaller than lists
+        self.block_devices = tuple([tuple(device) for device in self.block_devices or ()])
+
+
+class VolumeRow(Row):
+    __slots__ = ('id', 'tags', 'zone', 'status', 'size', 'type', 'create_time',
+                 'instance_id', 'device', 'attach_status')
+    INTERNED = ('zone', 'status', 'type', 'device', 'attach_status')
+
+
+def jsonable(obj):
+    """json.dumps(data, default=jsonable), for data with rows in it"""
+    if isinstance(obj, Row):
+        return obj.as_dict()
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+class InventoryCache(object):
+
+    def __init__(self, path=CACHE_PATH, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _connect(self):
+        ### one connection per call; sqlite connections can't be shared
+        ### between the threads of a multi-region scan
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+        if not os.path.exists(self.path):
+            ### every tag in the account is nobody else's business; sqlite
+            ### gives its -wal and -shm files the same permissions. A mode,
+            ### not the umask: that's the whole process's, threads and all
+            os.close(os.open(self.path, os.O_WRONLY | os.O_CREAT, 0600))
+
+        db = sqlite3.connect(self.path, timeout=10)
+        ### WAL, so readers never wait on a writer replacing a snapshot
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('CREATE TABLE IF NOT EXISTS snapshots ('
+                   '  region TEXT, kind TEXT, key TEXT, fetched_at REAL, data TEXT,'
+                   '  PRIMARY KEY (region, kind, key))')
+        return db
+
+    def load(self, region, kind, key=''):
+        """
+        Return (fetched_at, data) of the snapshot for this region/kind/key,
+        however old it is, or None if there isn't one.
+        """
+        try:
+            db = self._connect()
+            try:
+                row = db.execute('SELECT fetched_at, data FROM snapshots'
+                                 ' WHERE region = ? AND kind = ? AND key = ?',
+                                 (region, kind, key)).fetchone()
+            finally:
+                db.close()
+        except (sqlite3.Error, OSError), e:
+            logging.warning("inventory cache unavailable: %s" % e)
+            return None
+
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def store(self, region, kind, data, key=''):
+        """
+        Atomically replace the snapshot for this region/kind/key.
+        """
+        now = time.time()
+        try:
+            db = self._connect()
+            try:
+                with db:
+                    db.execute('INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?)',
+                               (region, kind, key, now, json.dumps(data, default=jsonable)))
+                    db.execute('DELETE FROM snapshots WHERE fetched_at < ?',
+                               (now - PURGE_AFTER,))
+            finally:
+                db.close()
+        except (sqlite3.Error, OSError), e:
+            logging.warning("could not update inventory cache: %s" % e)
+
+    def get(self, region, kind, key=''):
+        """
+        Return the cached rows for this region/kind/key, or None if there is
+        no snapshot younger than the TTL.
+        """
+        if not self.ttl:
+            return None
+
+        snapshot = self.load(region, kind, key)
+        if snapshot is None or time.time() - snapshot[0] > self.ttl:
+            return None
+
+        logging.debug("using cached %s for %s (%ds old)" %
+                      (kind, region, time.time() - snapshot[0]))
+        return snapshot[1]
+
+    def put(self, region, kind, rows, key=''):
+        """
+        Atomically replace the rows for this region/kind/key, if we cache.
+        """
+        if self.ttl:
+            self.store(region, kind, rows, key)
+
+
+def cached(cache, region, kind, row, fetch, key='', refresh=False):
+    """
+    Generator of the rows for region/kind/key: from the cache if they're
+    fresh, made into 'row' (the Row class fetch() makes), otherwise from
+    fetch(), whose rows are passed on as they come in, and stored once it
+    is done. 'refresh' skips the cache lookup, but still stores the new
+    snapshot.
+    """
+    if cache is not None and not refresh:
+        rows = cache.get(region, kind, key)
+        if rows is not None:
+            for data in rows:
+                yield row.from_dict(data)
+            return
+
+    ### only hang on to the rows if there's a snapshot to write
+    if cache is None or not cache.ttl:
+        for row in fetch():
+            yield row
+        return
+
+    rows = []
+    for row in fetch():
+        rows.append(row)
+        yield row
+
+    cache.put(region, kind, rows, key)
+
+
+def region_names(spec):
+    """
+    The regions named by a --region option: a comma-sep list of names, or
+    'all' for every region we have access to.
+    """
+    if spec != 'all':
+        return [name.strip() for name in spec.split(',') if name.strip()]
+
+    import boto.ec2
+    # we don't have access to gov regions in AWS:
+    return [region.name for region in boto.ec2.regions()
+            if '-gov-' not in region.name]
+
+
+def fetch_regions(regions, fetch, workers=DEFAULT_WORKERS, errors=None):
+    """
+    Run fetch(region), which returns an iterable of rows, for every region
+    on a pool of 'workers' threads, and generate (region, row) for all their
+    rows, merged in the order they come in. A region that fails is passed
+    to errors(region, exception) if given, and raised otherwise.
+    """
+    ### one region: no point in threads
+    if len(regions) == 1:
+        try:
+            for row in fetch(regions[0]):
+                yield regions[0], row
+        except Exception, e:
+            if not errors:
+                raise
+            errors(regions[0], e)
+        return
+
+    todo = Queue.Queue()
+    for region in regions:
+        todo.put(region)
+
+    ### bounded, so a fast region can't run away from a slow consumer
+    results = Queue.Queue(maxsize=workers * 4)
+
+    def worker():
+        while True:
+            try:
+                region = todo.get_nowait()
+            except Queue.Empty:
+                return
+
+            try:
+                batch = []
+                for row in fetch(region):
+                    batch.append(row)
+                    if len(batch) >= ROW_BATCH:
+                        results.put((region, batch, None))
+                        batch = []
+                results.put((region, batch, None))
+            except Exception, e:
+                results.put((region, [], e))
+
+            ### this region is done
+            results.put((region, None, None))
+
+    for _ in range(min(workers, len(regions))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    remaining = len(regions)
+    while remaining:
+        ### with a timeout, so ^C still works
+        region, batch, error = results.get(True, 86400)
+        if error:
+            if not errors:
+                raise error
+            errors(region, error)
+        elif batch is None:
+            remaining -= 1
+        else:
+            for row in batch:
+                yield region, row
+
+
+def iter_instances(conn, filters=None):
+    """
+    Generator of instance_row()s, a page of PAGE_SIZE instances at a time,
+    so callers get going on the first page while the rest is in flight, and
+    never hold more than a page of boto objects; and only until it's parsed.
+    """
+    next_token = None
+    while True:
+        page = conn.get_all_reservations(filters=filters, max_results=PAGE_SIZE,
+                                         next_token=next_token)
+        next_token = getattr(page, 'next_token', None)
+        rows = [instance_row(i) for r in page for i in r.instances]
+        ### let go of the boto objects before anybody sees a row
+        del page
+
+        for row in rows:
+            yield row
+        if not next_token:
+            break
+
+
+def iter_volumes(conn, filters=None):
+    """
+    Generator of volume_row()s. boto can't page through volumes, so they
+    all arrive in one response.
+    """
+    rows = [volume_row(v) for v in conn.get_all_volumes(filters=filters)]
+    for row in rows:
+        yield row
+
+
+def instance_row(i):
+    """
+    Project a boto Instance onto the fields our tools use.
+    """
+    return InstanceRow(
+        id=i.id,
+        tags=i.tags,
+        type=i.instance_type,
+        ### i.region is an object. i._placement is a string.
+        zone=str(i._placement),
+        group=i.groups[0].name if i.groups else '',
+        state=i.state,
+        root_device_type=i.root_device_type,
+        launch_time=i.launch_time,
+        block_devices=[(device, ebs.volume_id, ebs.delete_on_termination)
+                       for device, ebs in i.block_device_mapping.items()],
+    )
+
+
+def volume_row(v):
+    """
+    Project a boto Volume onto the fields our tools use.
+    """
+    return VolumeRow(
+        id=v.id,
+        tags=v.tags,
+        zone=v.zone,
+        status=v.status,
+        size=v.size,
+        type=v.type,
+        create_time=v.create_time,
+        instance_id=v.attach_data.instance_id,
+        device=v.attach_data.device,
+        attach_status=v.attach_data.status,
+    )
@@ -0,0 +1,119 @@
+#
+# Output formats for instances.py and volumes.py.
+#
+# 'table' is the Texttable output we always had; it needs every row before
+# it can print anything. The other formats are meant for piping into other
+# tools: each row is written out as soon as it's handed over, so memory use
+# stays flat, and the first row shows up right away.
+#
+import csv
+import sys
+import json
+
+from texttable  import Texttable
+
+FORMATS = [ 'table', 'tsv', 'csv', 'jsonl' ]
+
+def encode( value ):
+    """utf-8 bytes for text, str() for everything else, '' for None"""
+    if value is None:
+        return ''
+    if isinstance( value, unicode ):
+        return value.encode( 'utf-8' )
+    return str( value )
+
+class RowWriter(object):
+    """'columns' is a list of ( key, title, placeholder ): 'key' names the
+       field in jsonl, 'title' is the header, and 'placeholder' is what the
+       table shows for an empty cell."""
+
+    def __init__( self, columns, header=True, stream=sys.stdout ):
+        self.columns    = columns
+        self.header     = header
+        self.stream     = stream
+        self.count      = 0
+
+    def write( self, values ):
+        self.count += 1
+
+    def close( self ):
+        self.stream.flush()
+
+class TableWriter(RowWriter):
+
+    def __init__( self, columns, header=True, stream=sys.stdout ):
+        RowWriter.__init__( self, columns, header, stream )
+
+        self.table = Texttable( max_width=0 )
+        self.table.set_deco( Texttable.HEADER )
+        self.table.set_cols_dtype( [ 't' ] * len( columns ) )
+        self.table.set_cols_align( [ 'l' ] * len( columns ) )
+
+        if header:
+            ### using add_row, so the headers aren't being centered, for easier grepping
+            self.table.add_row( [ title for key, title, placeholder in columns ] )
+
+    def write( self, values ):
+        RowWriter.write( self, values )
+
+        ### XXX EVERY column in this output had better have a non-zero length
+        ### or texttable blows up with 'width must be greater than 0' error
+        self.table.add_row( [ value if value not in ( None, '' ) else placeholder
+                              for value, ( key, title, placeholder )
+                                in zip( values, self.columns ) ] )
+
+    def close( self ):
+        ### table.draw() blows up if there is nothing to print
+        if self.count or self.header:
+            self.stream.write( encode( self.table.draw() ) + '\n' )
+        RowWriter.close( self )
+
+class TSVWriter(RowWriter):
+
+    def __init__( self, columns, header=True, stream=sys.stdout ):
+        RowWriter.__init__( self, columns, header, stream )
+
+        if header:
+            self.write_line( [ title for key, title, placeholder in columns ] )
+
+    def write_line( self, values ):
+        ### tabs and newlines would break the format; nothing we print
+        ### should have them, but tags can hold anything
+        self.stream.write( '\t'.join( [ encode( value ).replace( '\t', ' ' ).replace( '\n', ' ' )
+                                        for value in values ] ) + '\n' )
+
+    def write( self, values ):
+        RowWriter.write( self, values )
+        self.write_line( values )
+
+class CSVWriter(RowWriter):
+
+    def __init__( self, columns, header=True, stream=sys.stdout ):
+        RowWriter.__init__( self, columns, header, stream )
+
+        self.csv = csv.writer( stream )
+        if header:
+            self.csv.writerow( [ title for key, title, placeholder in columns ] )
+
+    def write( self, values ):
+        RowWriter.write( self, values )
+        self.csv.writerow( [ encode( value ) for value in values ] )
+
+class JSONLinesWriter(RowWriter):
+
+    def write( self, values ):
+        RowWriter.write( self, values )
+        self.stream.write( json.dumps( dict( zip( [ key for key, title, placeholder
+                                                        in self.columns ], values ) ),
+                                       sort_keys=True ) + '\n' )
+
+WRITERS = {
+    'table':    TableWriter,
+    'tsv':      TSVWriter,
+    'csv':      CSVWriter,
+    'jsonl':    JSONLinesWriter,
+}
+
+def writer( format, columns, header=True, stream=sys.stdout ):
+    """a RowWriter for 'format', one of FORMATS"""
+    return WRITERS[ format ]( columns, header, stream )
@@ -0,0 +1,152 @@
+#
+# Tag search across ec2 regions, as used by search-ec2-tags.py and pssh.py.
+#
+# See search-ec2-tags.py for the query syntax, and its caveats.
+#
+#   from ec2search import search
+#   for hostname in search(['s_classes:s_puppetmaster'], workers=16):
+#       ...
+#
+import json
+import time
+import threading
+import Queue
+
+import ec2stats
+from ec2api import connect
+from ec2inventory import cached, instance_row, InstanceRow
+
+
+def get_regions(names=None):
+    """
+    All ec2 regions, or those whose name is in 'names' (a list, or the
+    comma-sep string from --regions).
+    """
+    import boto.ec2
+
+    regions = boto.ec2.regions()
+    if not names:
+        return regions
+    return [reg for reg in regions if reg.name in names]
+
+
+def build_query(args):
+    """
+    Turn the command line filters into the dict get_all_instances() expects.
+    """
+    query = {}
+    for arg in args:
+        string = arg.split(':', 1)
+        if len(string) == 2:
+            tag, val = string
+            # not in the dict yet? good! Add it.
+            if "tag:%s" % tag not in query:
+                query.update({"tag:%s" % tag: ['*' + val + '*']})
+            else:
+            # already there? extend the val (array) with another item:
+                query['tag:%s' % tag] = query.get('tag:%s' % tag) + ['*' + val + '*']
+        else:
+            if 'tag-value' not in query:
+                query.update({'tag-value': ['*' + string[0] + '*']})
+            else:
+                query['tag-value'] = query.get('tag-value') + ['*' + string[0] + '*']
+    return query
+
+
+def search_region(region, query, cache=None, refresh=False):
+    """
+    Return the Name tag of every instance in this region matching the query.
+    """
+    def fetch():
+        ec2 = connect(region.name)
+        return [instance_row(res.instances[0])
+                for res in ec2.get_all_instances(filters=query)]
+
+    rows = list(cached(cache, region.name, 'instances', InstanceRow, fetch,
+                       key=json.dumps(query, sort_keys=True), refresh=refresh))
+    names = [row['tags'].get('Name') for row in rows]
+    ec2stats.count(region.name, 'scanned', len(rows))
+    ec2stats.count(region.name, 'kept', len([name for name in names if name]))
+    return names
+
+
+def scan_regions(regions, query, workers=1, timeout=None, cache=None, refresh=False,
+                 region_search=search_region):
+    """
+    Query up to 'workers' regions at a time, and yield (region, names, error)
+    as each region finishes, in completion order. A region that takes longer
+    than 'timeout' seconds is abandoned, and yielded with a timeout error.
+    'region_search' does the querying, see search_region().
+    """
+    results = Queue.Queue()
+
+    def worker(region):
+        try:
+            results.put((region, region_search(region, query, cache, refresh), None))
+        except Exception, e:
+            results.put((region, [], e))
+
+    pending = [region for region in regions
+               # we don't have access to gov regions in AWS:
+               if '-gov-' not in region.name]
+    pending.reverse()
+    running = {}
+
+    while pending or running:
+        while pending and len(running) < max(workers, 1):
+            region = pending.pop()
+            thread = threading.Thread(target=worker, args=(region,))
+            # a region we gave up on must not keep the process alive
+            thread.daemon = True
+            thread.start()
+            running[region.name] = (region, time.time())
+
+        # wake up at least once a second, so deadlines get enforced
+        try:
+            region, names, error = results.get(timeout=1)
+        except Queue.Empty:
+            pass
+        else:
+            # already reported as timed out, drop the late answer
+            if region.name in running:
+                del running[region.name]
+                yield region, names, error
+
+        if timeout:
+            now = time.time()
+            for name, (region, started) in running.items():
+                if now - started > timeout:
+                    del running[name]
+                    yield region, [], 'timed out after %ss' % timeout
+
+
+def search(args, regions=None, workers=1, timeout=None, cache=None, refresh=False,
+           errors=None, index=False):
+    """
+    Generator of the hostnames (Name tags) matching the command line style
+    filters in 'args', yielded as each region finishes, so callers can get
+    started on the first hosts while slower regions are still running.
+    Regions that fail are passed to errors(region, error), if given. With
+    'index', 'args' is an ec2index query, run against the local tag index,
+    like search-ec2-tags.py does without --api.
+    """
+    if index:
+        from ec2index import parse, search_region as region_search
+        query = parse(args)
+    else:
+        query, region_search = build_query(args), search_region
+
+    if regions is None:
+        regions = get_regions()
+
+    for region, names, error in scan_regions(regions, query, workers, timeout, cache,
+                                             refresh, region_search):
+        if error:
+            if errors:
+                errors(region, error)
+            continue
+
+        for name in names:
+            # untagged instances have no name to ssh to
+            if name:
+                yield name
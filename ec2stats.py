@@ -0,0 +1,223 @@
+#
+# Instrumentation behind the tools' --stats (a.k.a. --profile) option.
+#
+# With it, a JSON summary is written to stderr when the tool exits:
+#
+#   phases      wall time per phase (import, connect, api, filter, render,
+#               ...); phases that run in several threads at once are summed,
+#               so they can add up to more than 'total'
+#   regions     per region: EC2 requests, describe pages, bytes received,
+#               seconds spent in API calls, and resources scanned vs. kept
+#   histograms  latencies (e.g. per host in pssh.py): count, min/mean/max,
+#               and how many fell in each power of two bucket of ms
+#
+# Without it, the per-row and per-request hooks are never installed (see
+# instrument(), counted() and timed()), so there is nothing to pay; only the
+# phases, a handful per run, are timed regardless.
+#
+import sys
+import json
+import time
+import atexit
+import threading
+
+START = time.time()     # about when the tool started; import this first
+
+_enabled = False
+_lock = threading.Lock()
+_phases = {}            # name -> seconds
+_regions = {}           # region -> {counter: value}
+_histograms = {}        # name -> {'count', 'sum', 'min', 'max', 'buckets'}
+
+# the boto EC2Connection methods our tools make requests with
+API_CALLS = ['get_all_reservations', 'get_all_instances', 'get_all_volumes',
+             'create_tags']
+DESCRIBE_CALLS = ['get_all_reservations', 'get_all_instances', 'get_all_volumes']
+
+
+def enable():
+    """start collecting, and report on exit"""
+    global _enabled
+    if not _enabled:
+        _enabled = True
+        atexit.register(report)
+
+
+def enabled():
+    return _enabled
+
+
+def add_time(name, seconds):
+    with _lock:
+        _phases[name] = _phases.get(name, 0) + seconds
+
+
+def checkpoint(name):
+    """record the time since START as phase 'name', e.g. for 'import'"""
+    add_time(name, time.time() - START)
+
+
+class phase(object):
+    """
+    Time a block as phase 'name':
+
+        with ec2stats.phase('render'):
+            out.close()
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        add_time(self.name, time.time() - self.start)
+
+
+def count(region, name, value=1):
+    """add 'value' to the counter 'name' of 'region'"""
+    if not _enabled:
+        return
+    with _lock:
+        counters = _regions.setdefault(region, {})
+        counters[name] = counters.get(name, 0) + value
+
+
+def observe(name, seconds):
+    """add a latency to histogram 'name'"""
+    if not _enabled:
+        return
+
+    ms = seconds * 1000
+    bucket = 1
+    while bucket < ms:
+        bucket *= 2
+
+    with _lock:
+        hist = _histograms.setdefault(name, {'count': 0, 'sum': 0, 'min': None,
+                                             'max': 0, 'buckets': {}})
+        hist['count'] += 1
+        hist['sum'] += seconds
+        hist['min'] = seconds if hist['min'] is None else min(hist['min'], seconds)
+        hist['max'] = max(hist['max'], seconds)
+        hist['buckets'][bucket] = hist['buckets'].get(bucket, 0) + 1
+
+
+def timed(name, func):
+    """func, adding the time spent in it to phase 'name', if we collect"""
+    if not _enabled:
+        return func
+
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            add_time(name, time.time() - start)
+    return wrapper
+
+
+def counted(pairs, name):
+    """
+    Pass on the (region, item) pairs from 'pairs', counting them per region
+    as 'name' (e.g. 'scanned', 'kept'), if we collect.
+    """
+    if not _enabled:
+        return pairs
+    return _counted(pairs, name)
+
+
+def _counted(pairs, name):
+    for region, item in pairs:
+        count(region, name)
+        yield region, item
+
+
+def instrument(conn, region):
+    """
+    Count the requests, describe pages, response bytes and API time of a
+    boto EC2 connection against 'region', if we collect. Returns 'conn'.
+    """
+    if not _enabled:
+        return conn
+
+    # boto's get_all_instances() is get_all_reservations() under the hood;
+    # only count the outermost call
+    calling = threading.local()
+
+    def wrap(method, describe):
+        def wrapper(*args, **kwargs):
+            if getattr(calling, 'busy', False):
+                return method(*args, **kwargs)
+
+            calling.busy = True
+            start = time.time()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                calling.busy = False
+                seconds = time.time() - start
+                add_time('api', seconds)
+                count(region, 'requests')
+                count(region, 'api_seconds', seconds)
+                if describe:
+                    count(region, 'pages')
+        return wrapper
+
+    for name in API_CALLS:
+        if hasattr(conn, name):
+            setattr(conn, name, wrap(getattr(conn, name), name in DESCRIBE_CALLS))
+
+    # every response body is read through make_request's HTTPResponse
+    if hasattr(conn, 'make_request'):
+        make_request = conn.make_request
+
+        def counting_make_request(*args, **kwargs):
+            response = make_request(*args, **kwargs)
+            read = response.read
+
+            def counting_read(*args):
+                data = read(*args)
+                count(region, 'bytes', len(data or ''))
+                return data
+            response.read = counting_read
+            return response
+        conn.make_request = counting_make_request
+
+    return conn
+
+
+def summary():
+    """everything collected so far, as a dict"""
+    with _lock:
+        phases = dict(_phases)
+        phases['total'] = time.time() - START
+
+        totals = {}
+        for counters in _regions.values():
+            for name, value in counters.items():
+                totals[name] = totals.get(name, 0) + value
+
+        histograms = {}
+        for name, hist in _histograms.items():
+            histograms[name] = {
+                'count': hist['count'],
+                'min': hist['min'],
+                'mean': hist['sum'] / hist['count'],
+                'max': hist['max'],
+                # upper bound in ms -> number of observations
+                'buckets_ms': dict([(str(bucket), n)
+                                    for bucket, n in sorted(hist['buckets'].items())]),
+            }
+
+        return {'phases': phases, 'regions': dict(_regions), 'totals': totals,
+                'histograms': histograms}
+
+
+def report(stream=None):
+    """write the summary to 'stream' (stderr), as one JSON document"""
+    stream = stream or sys.stderr
+    stream.write(json.dumps(summary(), sort_keys=True) + '\n')
+    stream.flush()
@@ -0,0 +1,231 @@
+#
+# Incremental inventory sync for instances.py and volumes.py.
+#
+# Keeps a snapshot of every instance (or volume) in a region in the
+# inventory cache, and brings it up to date by describing only what can
+# have changed since the last sync:
+#
+#   * resources in a transitional state (pending, stopping, creating, ...)
+#   * resources launched/created since the last sync
+#   * resources that were in a transitional state in the snapshot, by id,
+#     to see what they turned into (or that they're gone)
+#
+# EC2 has no 'changed since' filter, so some changes slip through these:
+# any that start and finish between two syncs, without the resource ever
+# being seen in transition (e.g. a volume attached, or detached, or a tag
+# edit); a full describe every FULL_SYNC_INTERVAL seconds reconciles those.
+#
+# Each sync reports what was added, removed and changed.
+#
+import sys
+import time
+import logging
+from operator import itemgetter
+
+from ec2inventory import iter_instances, iter_volumes, InstanceRow, VolumeRow
+
+FULL_SYNC_INTERVAL = 900    # seconds between full reconciliations
+ID_BATCH_SIZE = 200         # ids per describe call, when re-checking by id
+SYNC_KEY = 'sync'           # cache key the snapshots live under
+
+INSTANCE_TRANSITIONS = ['pending', 'stopping', 'shutting-down']
+VOLUME_TRANSITIONS = ['creating', 'deleting']
+ATTACHMENT_TRANSITIONS = ['attaching', 'detaching']
+
+
+def synced(conn, region, kind, cache, full_sync_every, full=False, changes=False):
+    """
+    With instances.py or volumes.py --sync: the region's resources from the
+    synced snapshot (the server side filters don't apply; the snapshot holds
+    everything), sorted by id, or with 'changes', only what this sync added,
+    removed or changed.
+    """
+    rows, found = InventorySync(cache, region, kind, full_sync_every).sync(conn, full=full)
+    sys.stderr.write("%s %s: %s\n" % (region, kind.name, found))
+
+    if changes:
+        return found.rows()
+    return sorted(rows.values(), key=itemgetter('id'))
+
+
+FAILED_REGIONS = []         # the regions region_failed() was called for
+
+
+def region_failed(region, error):
+    """
+    What the tools do with a region that fails: log it, and carry on; it's
+    noted in FAILED_REGIONS, so they can exit non-zero when they're done.
+    """
+    logging.error("%s: %s" % (region, error))
+    FAILED_REGIONS.append(region)
+
+
+def days_since(since):
+    """
+    Wildcard filter values matching every UTC day from 'since' until now,
+    for the launch-time/create-time filters: ['2014-06-01T*', ...]
+    """
+    days = []
+    day = since - since % 86400
+    while day <= time.time():
+        days.append(time.strftime('%Y-%m-%dT*', time.gmtime(day)))
+        day += 86400
+    return days
+
+
+def by_id(ids, id_filter):
+    """filters= dicts re-checking 'ids', ID_BATCH_SIZE at a time"""
+    ids = sorted(ids)
+    return [{id_filter: ids[idx:idx + ID_BATCH_SIZE]}
+            for idx in range(0, len(ids), ID_BATCH_SIZE)]
+
+
+class Kind(object):
+    """
+    How to sync one kind of resource: how to list them (with filters), and
+    which filters find the ones that may have changed.
+    """
+
+    def __init__(self, name, row, fetch, id_filter, in_transition, delta_filters):
+        self.name = name
+        self.row = row                      # ec2inventory.Row class of the rows
+        self.fetch = fetch                  # fetch(conn, filters) -> rows
+        self.id_filter = id_filter          # filter name for resource ids
+        self.in_transition = in_transition  # in_transition(row) -> bool
+        self.delta_filters = delta_filters  # delta_filters(since) -> [filters]
+
+
+INSTANCES = Kind(
+    'instances', InstanceRow, iter_instances, 'instance-id',
+    lambda row: row['state'] in INSTANCE_TRANSITIONS,
+    lambda since: [{'instance-state-name': INSTANCE_TRANSITIONS},
+                   {'launch-time': days_since(since)}])
+
+VOLUMES = Kind(
+    'volumes', VolumeRow, iter_volumes, 'volume-id',
+    lambda row: (row['status'] in VOLUME_TRANSITIONS or
+                 row['attach_status'] in ATTACHMENT_TRANSITIONS),
+    lambda since: [{'status': VOLUME_TRANSITIONS},
+                   {'attachment.status': ATTACHMENT_TRANSITIONS},
+                   {'create-time': days_since(since)}])
+
+
+class Changes(object):
+    """What a sync found: lists of rows, and (old, new) pairs for changed"""
+
+    def __init__(self, full=False):
+        self.full = full
+        self.added = []
+        self.removed = []
+        self.changed = []
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    def rows(self):
+        """
+        The added, removed and (new versions of) changed rows, each with a
+        'change' of '+', '-' or '~'.
+        """
+        return [dict(row, change='+') for row in self.added] + \
+               [dict(row, change='-') for row in self.removed] + \
+               [dict(new, change='~') for old, new in self.changed]
+
+    def __str__(self):
+        return "%s sync: %d added, %d removed, %d changed" % \
+            ('full' if self.full else 'delta', len(self.added),
+             len(self.removed), len(self.changed))
+
+
+class InventorySync(object):
+    """
+    The synced snapshot of one kind of resource (INSTANCES, VOLUMES) in one
+    region, stored in an ec2inventory.InventoryCache. Without 'store', the
+    snapshot is only read from the cache, and later syncs carry on in
+    memory: a sync stores what changed as seen, so a --sync --changes run
+    next to, say, instances.py --watch would miss what the watch saw.
+    """
+
+    def __init__(self, cache, region, kind, full_every=FULL_SYNC_INTERVAL, store=True):
+        self.cache = cache
+        self.region = region
+        self.kind = kind
+        self.full_every = full_every
+        self.store = store
+        self.state = None       # (rows, synced_at, full_at), after the first sync()
+
+    def load(self):
+        """(rows, synced_at, full_at) of the snapshot in the cache"""
+        snapshot = self.cache.load(self.region, self.kind.name, SYNC_KEY)
+        if snapshot is None:
+            return {}, 0, 0
+
+        state = snapshot[1]
+        rows = dict([(id, self.kind.row.from_dict(row))
+                     for id, row in state['rows'].items()])
+        return rows, state['synced_at'], state['full_at']
+
+    def sync(self, conn, full=False):
+        """
+        Bring the snapshot up to date, and return (rows, Changes), with
+        rows a dict of id -> row for everything in the region. The snapshot
+        is only read from the cache by the first sync; later ones (the
+        daemon's, instances.py --watch's) carry on from the last.
+        """
+        if self.state is None:
+            self.state = self.load()
+        now = time.time()
+
+        # a new dict, so the rows handed out by the last sync stay as they were
+        rows, synced_at, full_at = self.state
+        rows = dict(rows)
+
+        if full or now - full_at > self.full_every:
+            changes = self.full_sync(conn, rows)
+            full_at = now
+        else:
+            changes = self.delta_sync(conn, rows, synced_at)
+
+        logging.debug("%s %s: %s" % (self.region, self.kind.name, changes))
+
+        if self.store:
+            self.cache.store(self.region, self.kind.name,
+                             {'rows': rows, 'synced_at': now, 'full_at': full_at},
+                             SYNC_KEY)
+        self.state = rows, now, full_at
+        return rows, changes
+
+    def apply(self, rows, found, gone, changes):
+        """update 'rows' in place with what we found, recording the changes"""
+        for row in found.values():
+            old = rows.get(row['id'])
+            if old is None:
+                changes.added.append(row)
+            elif old != row:
+                changes.changed.append((old, row))
+            rows[row['id']] = row
+
+        for id in gone:
+            if id in rows:
+                changes.removed.append(rows.pop(id))
+
+    def full_sync(self, conn, rows):
+        changes = Changes(full=True)
+        found = dict([(row['id'], row) for row in self.kind.fetch(conn, None)])
+        self.apply(rows, found, [id for id in rows if id not in found], changes)
+        return changes
+
+    def delta_sync(self, conn, rows, since):
+        changes = Changes()
+
+        ### the ones we last saw in the middle of something
+        pending = [id for id, row in rows.items() if self.kind.in_transition(row)]
+
+        found = {}
+        for filters in self.kind.delta_filters(since) + by_id(pending, self.kind.id_filter):
+            for row in self.kind.fetch(conn, filters):
+                found[row['id']] = row
+
+        ### and if they're not there anymore, they're gone
+        self.apply(rows, found, [id for id in pending if id not in found], changes)
+        return changes
@@ -1,15 +1,39 @@
 #!python
 
-import re
+### Also a library; importing it has no side effects, and boto is only
+### imported once there's ec2 to talk to:
+###
+###   from optparse import Values
+###   from instances import get_instances, instance_filters
+###
+###   predicates, filters = instance_filters( Values( { 'zone': 'us-east-1a' } ) )
+###   for region, i in get_instances( [ 'us-east-1' ], predicates, filters ):
+###       ...
+###
 import sys
+import time
+import signal
+import json
 import logging
 
-import boto.ec2
-
-from texttable  import Texttable
+import ec2stats
+import ec2aggregate
+
+from ec2api       import connect
+from ec2daemon    import Client
+from ec2filters   import server_filters, compile_predicates, matches, tag
+from ec2inventory import InventoryCache, DEFAULT_TTL, DEFAULT_WORKERS, cached, \
+                         region_names, fetch_regions, iter_instances, InstanceRow
+from ec2output    import FORMATS, writer
+from ec2sync      import InventorySync, Changes, INSTANCES, FULL_SYNC_INTERVAL, \
+                         synced, region_failed, FAILED_REGIONS
+from volumes      import fetch_volumes
+from operator   import itemgetter
 from pprint     import PrettyPrinter
 from optparse   import OptionParser
 
+ec2stats.checkpoint( 'import' )
+
 PP = PrettyPrinter( indent=2 )
 
 ###################
@@ -21,8 +45,33 @@ parser.add_option(  "-v", "--verbose",      default=None, action="store_true",
                     help="enable debug output" )
 parser.add_option(  "-H", "--no-header",    default=None, action="store_true",
                     help="suppress table header" )
+parser.add_option(  "-f", "--format",       default='table', type="choice", choices=FORMATS,
+                    help="output format: %s (default: table)" % ', '.join( FORMATS ) )
 parser.add_option(  "-r", "--region",       default='us-east-1',
-                    help="ec2 region to connect to" )
+                    help="ec2 region(s) to connect to: comma-sep, or 'all'" )
+parser.add_option(  "-p", "--parallel",     default=DEFAULT_WORKERS, type="int",
+                    help="number of regions to fetch at the same time" )
+parser.add_option(  "--cache-ttl",          default=DEFAULT_TTL, type="int",
+                    help="reuse inventory fetched in the last N seconds (0 disables)" )
+parser.add_option(  "--refresh",            default=None, action="store_true",
+                    help="ignore the inventory cache, and fetch from ec2" )
+parser.add_option(  "--sync",               default=None, action="store_true",
+                    help="keep a local snapshot, and only fetch what changed since the last run" )
+parser.add_option(  "--full-sync-every",    default=FULL_SYNC_INTERVAL, type="int",
+                    help="with --sync, fetch everything every N seconds (--refresh: now)" )
+parser.add_option(  "--changes",            default=None, action="store_true",
+                    help="with --sync, only show what was added (+), removed (-) or changed (~)" )
+parser.add_option(  "-j", "--join-volumes", default=None, action="store_true",
+                    help="show the count, total size (GiB) and types of each instance's volumes" )
+parser.add_option(  "--group-by",         default=None,
+                    help="only show these fields' groups, comma-sep (e.g. zone,type; region, tag:Key)" )
+parser.add_option(  "--agg",                default=None,
+                    help="with --group-by, what to show per group: count, sum(field), avg(), min(), max() (default: count)" )
+parser.add_option(  "-w", "--watch",        default=None, type="float", metavar="INTERVAL",
+                    help="keep watching, every INTERVAL seconds (less often when nothing happens), "
+                         "showing only what changed" )
+parser.add_option(  "--stats", "--profile", default=None, action="store_true",
+                    help="write timings and API request counts to stderr, as JSON" )
 parser.add_option(  "-g", "--group",        default=None,
                     help="Include instances from these groups only (regex)" )
 parser.add_option(  "-G", "--exclude-group",default=None,
@@ -45,135 +94,344 @@ parser.add_option(  "-S", "--exclude-state",default=None,
                     help="Exclude instances with these states (regex)" )
 
 
-(options, args) = parser.parse_args()
-
 ###################
-### Logging
+### Filters
 ###################
 
-if options.verbose: log_level = logging.DEBUG
-else:               log_level = logging.INFO
-
-logging.basicConfig(stream=sys.stdout, level=log_level)
-logging.basicConfig(stream=sys.stderr, level=(logging.ERROR,logging.CRITICAL))
-
+### most selective first, see compile_predicates()
+FIELDS = [
+    ( 'name',   tag( 'Name' ) ),
+    ( 'group',  itemgetter( 'group' ) ),
+    ( 'type',   itemgetter( 'type' ) ),
+    ( 'state',  itemgetter( 'state' ) ),
+    ( 'zone',   itemgetter( 'zone' ) ),
+]
+
+### include options that are simple enough to let ec2 do the filtering;
+### the predicates still run on whatever comes back
+SERVER_FILTERS = {
+    'name':  ( 'tag:Name',            False ),
+    'type':  ( 'instance-type',       True ),
+    'zone':  ( 'availability-zone',   True ),
+    'state': ( 'instance-state-name', True ),
+}
+
+def instance_filters( options ):
+    """( predicates, server side filters ) for the include/exclude options
+       (name, group, type, state, zone, and their exclude_*) set on
+       'options', e.g. optparse.Values( { 'state': 'running' } )."""
+    return compile_predicates( options, FIELDS ), server_filters( options, SERVER_FILTERS )
+
+### the fields --group-by and --agg know, besides 'region' and 'tag:Key'
+AGG_FIELDS = dict( FIELDS + [
+    ( 'id',     itemgetter( 'id' ) ),
+    ( 'root',   itemgetter( 'root_device_type' ) ),
+] )
 
 ###################
-### Connection
+### Fetching
 ###################
 
-conn = boto.ec2.connect_to_region( options.region )
+def fetch_instances( region, filters=None, cache=None, daemon=None, refresh=False,
+                     sync=False, full_sync_every=FULL_SYNC_INTERVAL, changes=False ):
+    """The instance rows of one region: from the inventory daemon if there
+       is one, from the cache if it's fresh enough, or with server side
+       'filters' from ec2. With 'sync', from the synced snapshot instead,
+       see synced()."""
+    ### the inventory daemon has it all in memory, if it's running, and
+    ### synced no longer than the cache ttl ago
+    if daemon and cache and not ( sync or refresh ):
+        rows = daemon.rows( 'instances', region, cache.ttl )
+        if rows is not None:
+            return rows
+
+    ### a connection per region (and thread); boto's aren't thread safe
+    conn = connect( region )
+
+    if sync:
+        return synced( conn, region, INSTANCES, cache, full_sync_every, refresh, changes )
+
+    return cached( cache, region, 'instances', InstanceRow,
+                   lambda: iter_instances( conn, filters or None ),
+                   key=json.dumps( filters, sort_keys=True ) if filters else '',
+                   refresh=refresh )
+
+def get_instances( regions, predicates=(), filters=None, cache=None, daemon=None,
+                   workers=DEFAULT_WORKERS, errors=region_failed, **kwargs ):
+    """Generator of ( region, instance ) for the instances matching the
+       'predicates' (see instance_filters()), in all 'regions', fetched
+       'workers' regions at a time. Other keyword arguments go to
+       fetch_instances()."""
+    fetch = lambda region: fetch_instances( region, filters, cache, daemon, **kwargs )
+
+    ### with --stats, count what comes in and what makes it through
+    keep = ec2stats.timed( 'filter', matches )
+    rows = ec2stats.counted( fetch_regions( regions, fetch, workers, errors ), 'scanned' )
+    return ec2stats.counted( ( ( region, i ) for region, i in rows
+                                if keep( i, predicates ) ), 'kept' )
 
 ###################
-### Regexes
+### Volumes join
 ###################
 
-regexes = {}
-for opt in [ 'group', 'exclude_group', 'name', 'exclude_name',
-             'type',  'exclude_type',  'zone', 'exclude_zone',
-             'state', 'exclude_state' ]:
-
-    ### we have a regex we should build
-    if options.__dict__.get( opt, None ):
-        regexes[ opt ] = re.compile( options.__dict__.get( opt ), re.IGNORECASE )
-
-#PP.pprint( regexes )
-
-def get_instances():
-    instances   = [ i for r in conn.get_all_instances()
-                        for i in r.instances ]
-
-    rv          = [];
-    for i in instances:
-
-        ### we will assume this node is one of the nodes we want
-        ### to operate on, and we will unset this flag if any of
-        ### the criteria fail
-        wanted_node = True
-
-        for re_name, regex in regexes.iteritems():
-
-            ### What's the value we will be testing against?
-            if re.search( 'group', re_name ):
-                value = i.groups[0].name
-            elif re.search( 'name', re_name ):
-                value = i.tags.get( 'Name', '' )
-            elif re.search( 'type', re_name ):
-                value = i.instance_type
-            elif re.search( 'state', re_name ):
-                value = i.state
-            elif re.search( 'zone', re_name ):
-                ### i.region is an object. i._placement is a string.
-                value = str(i._placement)
-
-            else:
-                logging.error( "Don't know what to do with: %s" % re_name )
-                continue
+def volume_details( regions, cache=None, daemon=None, workers=DEFAULT_WORKERS,
+                    errors=region_failed, **kwargs ):
+    """The build side of the instance/volume join: a dict of volume id ->
+       ( size in GiB, type ) for every volume in 'regions', from one bulk
+       fetch per region (see fetch_volumes(), which gets the other keyword
+       arguments), rather than a lookup per instance."""
+    fetch = lambda region: fetch_volumes( region, None, cache, daemon, **kwargs )
 
-            #PP.pprint( "name = %s value = %s pattern = %s" % ( re_name, value, regex.pattern ) )
+    return dict( ( v['id'], ( v['size'], v['type'] ) )
+                 for region, v in fetch_regions( regions, fetch, workers, errors ) )
 
-            ### Should the regex match or not match?
-            if re.search( 'exclude', re_name ):
-                rv_value = None
-            else:
-                rv_value = True
+def attached_volumes( i, volumes ):
+    """( count, total GiB, comma-sep types ) of the volumes attached to
+       instance 'i', probing the volume_details() 'volumes'."""
+    count, size, types = 0, 0, set()
+    for device, volume_id, delete_on_termination in i['block_devices']:
+        count += 1
+        details = volumes.get( volume_id )
 
-            ### if the match is not what we expect, then clearly we
-            ### don't care about the node
-            result = regex.search( value )
+        ### gone, or created since the volumes were fetched
+        if details is None:
+            types.add( '?' )
+            continue
 
-            ### we expected to get no results, excellent
-            if result == None and rv_value == None:
-                pass
+        size += details[ 0 ] or 0
+        types.add( details[ 1 ] or '?' )
 
-            ### we expected to get some match, excellent
-            elif result is not None and rv_value is not None:
-                pass
+    return count, size, ','.join( sorted( types ) )
 
-            ### we don't care about this node
-            else:
-                wanted_node = False
-                break
-
-        if wanted_node:
-            rv.append( i )
-
-    return rv
-
-def list_instances():
-    table       = Texttable( max_width=0 )
-
-    table.set_deco( Texttable.HEADER )
-    table.set_cols_dtype( [ 't', 't', 't', 't', 't', 't', 't', 't' ] )
-    table.set_cols_align( [ 'l', 'l', 'l', 'l', 'l', 'l', 'l', 't' ] )
-
-    if not options.no_header:
-        ### using add_row, so the headers aren't being centered, for easier grepping
-        table.add_row(
-            [ '# id', 'Name', 'Type', 'Zone', 'Group', 'State', 'Root', 'Volumes' ] )
-
-    instances = get_instances()
-    for i in instances:
-
-        ### XXX there's a bug where you can't get the size of the volumes, it's
-        ### always reported as None :(
-        volumes = ", ".join( [ ebs.volume_id for ebs in i.block_device_mapping.values()
-                                if ebs.delete_on_termination == False ] )
-
-        ### you can use i.region instead of i._placement, but it pretty
-        ### prints to RegionInfo:us-east-1. For now, use the private version
-        ### XXX EVERY column in this output had better have a non-zero length
-        ### or texttable blows up with 'width must be greater than 0' error
-        table.add_row( [ i.id, i.tags.get( 'Name', ' ' ), i.instance_type,
-                         i._placement , i.groups[0].name, i.state,
-                         i.root_device_type, volumes or '-' ] )
+###################
+### Watching
+###################
 
-        #PP.pprint( i.__dict__ )
-
-    ### table.draw() blows up if there is nothing to print
-    if instances or not options.no_header:
-        print table.draw()
+### polling a quiet fleet backs off to up to this many times --watch, but
+### no further than WATCH_MAX_DELAY seconds: an instance that starts and
+### finishes a transition (pending, stopping, ...) between two ticks isn't
+### seen by a delta sync, until the next full one
+WATCH_BACKOFF   = 8
+WATCH_MAX_DELAY = 10
+
+def watch( regions, cache, interval, workers=DEFAULT_WORKERS,
+           full_sync_every=FULL_SYNC_INTERVAL, errors=region_failed ):
+    """Generator of ticks, lists of ( region, rows, Changes ): a sync of
+       every region's instances, every 'interval' seconds, or up to
+       WATCH_BACKOFF times (and WATCH_MAX_DELAY seconds) less often while
+       nothing happens. The first sync has every instance as added; after
+       that, each is a delta sync (see ec2sync), which only describes the
+       instances that can have changed: in transition, or just launched.
+       The synced snapshot is read from 'cache', but the ticks aren't
+       written back."""
+    syncs   = dict( ( region, InventorySync( cache, region, INSTANCES, full_sync_every,
+                                             store=False ) )
+                        for region in regions )
+    conns   = {}
+    seen    = set()
+
+    def tick( region ):
+        ### one warm connection per region; a region is only ever synced
+        ### by one thread at a time
+        if region not in conns:
+            conns[ region ] = connect( region )
+        rows, changes = syncs[ region ].sync( conns[ region ] )
+
+        if region not in seen:
+            seen.add( region )
+            changes = Changes( changes.full )
+            changes.added = sorted( rows.values(), key=itemgetter( 'id' ) )
+        return [ ( rows, changes ) ]
+
+    delay = interval
+    while True:
+        rv = [ ( region, rows, changes ) for region, ( rows, changes )
+                    in fetch_regions( regions, tick, workers, errors ) ]
+        yield rv
+
+        ### something going on, or about to: keep a close eye on it
+        busy = [ 1 for region, rows, changes in rv if changes ] or \
+               [ 1 for region, rows, changes in rv
+                        for i in rows.itervalues() if INSTANCES.in_transition( i ) ]
+        longest = max( interval, min( interval * WATCH_BACKOFF, WATCH_MAX_DELAY ) )
+        delay = interval if busy else min( delay * 2, longest )
+        time.sleep( delay )
+
+def transition( old, new ):
+    """what the State column shows for a changed instance"""
+    if old[ 'state' ] == new[ 'state' ]:
+        return new[ 'state' ]
+    return '%s -> %s' % ( old[ 'state' ], new[ 'state' ] )
+
+### ( key, title, shown in the table when empty ), see ec2output
+COLUMNS = [ ( 'id',         '# id',     ' ' ),
+            ( 'name',       'Name',     ' ' ),
+            ( 'type',       'Type',     ' ' ),
+            ( 'zone',       'Zone',     ' ' ),
+            ( 'group',      'Group',    ' ' ),
+            ( 'state',      'State',    ' ' ),
+            ( 'root',       'Root',     ' ' ),
+            ( 'volumes',    'Volumes',  '-' ) ]
+REGION_COLUMN = ( 'region', 'Region', ' ' )
+JOIN_COLUMNS  = [ ( 'volume_count', 'Vols',      ' ' ),
+                  ( 'volume_gib',   'GiB',       ' ' ),
+                  ( 'volume_types', 'Vol types', '-' ) ]
+CHANGE_COLUMN = ( 'change', 'Change', ' ' )
+
+def table_row( i, details=None ):
+    """the COLUMNS (and with volume 'details', JOIN_COLUMNS) of instance 'i'"""
+    ### the size isn't in the block device mapping (it's always None);
+    ### --join-volumes gets it from the volumes themselves
+    volumes = ", ".join( [ volume_id for device, volume_id, delete_on_termination
+                                in i['block_devices']
+                            if delete_on_termination == False ] )
+
+    row = [ i['id'], i['tags'].get( 'Name', '' ), i['type'],
+            i['zone'], i['group'], i['state'],
+            i['root_device_type'], volumes ]
+    if details is not None:
+        row.extend( attached_volumes( i, details ) )
+    return row
+
+def watch_instances( options, regions, cache, predicates ):
+    """With --watch: list the instances, then every tick, only those that
+       were added (+), removed (-) or changed (~), and the state changes"""
+    multi_region = len( regions ) > 1
+
+    columns = COLUMNS
+    if multi_region:
+        columns = columns[ :1 ] + [ REGION_COLUMN ] + columns[ 1: ]
+    columns = columns[ :1 ] + [ CHANGE_COLUMN ] + columns[ 1: ]
+
+    ### a table per tick; the streaming formats get a header once
+    header = not options.no_header
+    state  = [ key for key, title, placeholder in columns ].index( 'state' )
+
+    for ticks, regions_changes in enumerate( watch( regions, cache, options.watch,
+                                                    options.parallel,
+                                                    options.full_sync_every ) ):
+        shown = []
+        for region, rows, changes in regions_changes:
+            if ticks and changes:
+                sys.stderr.write( "%s %s: %s\n" % ( time.strftime( '%H:%M:%S' ),
+                                                    region, changes ) )
+
+            for change, old, new in [ ( '+', i, i ) for i in changes.added ] + \
+                                    [ ( '-', i, i ) for i in changes.removed ] + \
+                                    [ ( '~', o, n ) for o, n in changes.changed ]:
+                ### an instance leaving (or joining) the selection is news too
+                if not ( matches( old, predicates ) or matches( new, predicates ) ):
+                    continue
+
+                row = table_row( new )
+                if multi_region:
+                    row.insert( 1, region )
+                row.insert( 1, change if ticks else '' )
+                if change == '~':
+                    row[ state ] = transition( old, new )
+                shown.append( row )
+
+        if not shown and ticks:
+            continue
+
+        out = writer( options.format, columns, header=header )
+        for row in shown:
+            out.write( row )
+        out.close()
+
+        if options.format != 'table':
+            header = False
+
+def list_instances( options ):
+    regions     = region_names( options.region )
+    cache       = InventoryCache( ttl=options.cache_ttl )
+    daemon      = Client()
+    predicates, filters = instance_filters( options )
+    aggregator  = ec2aggregate.grouping( options, AGG_FIELDS, parser )
+
+    if options.watch:
+        if aggregator or options.join_volumes:
+            parser.error( "--watch shows instances, not --group-by or --join-volumes" )
+        try:
+            watch_instances( options, regions, cache, predicates )
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if aggregator:
+        ec2aggregate.summarize( options, aggregator,
+                    get_instances( regions, predicates, filters, cache, daemon,
+                                   options.parallel, refresh=options.refresh,
+                                   sync=options.sync, changes=options.changes,
+                                   full_sync_every=options.full_sync_every ),
+                    parser )
+        return
+
+    ### with more than one region, say which one every row came from
+    multi_region = len( regions ) > 1
+
+    columns = COLUMNS
+    if options.join_volumes:
+        columns = columns + JOIN_COLUMNS
+    if multi_region:
+        ### right after the id; '# id' stays in front, for easier grepping
+        columns = columns[ :1 ] + [ REGION_COLUMN ] + columns[ 1: ]
+    if options.changes:
+        columns = columns[ :1 ] + [ CHANGE_COLUMN ] + columns[ 1: ]
+
+    out = writer( options.format, columns, header=not options.no_header )
+    write = ec2stats.timed( 'render', out.write )
+
+    ### hash join: every volume in memory by id, then stream the instances
+    ### past them; two sweeps per region, however many instances there are
+    if options.join_volumes:
+        with ec2stats.phase( 'join' ):
+            details = volume_details( regions, cache, daemon, options.parallel,
+                                      refresh=options.refresh, sync=options.sync,
+                                      full_sync_every=options.full_sync_every )
+
+    for region, i in get_instances( regions, predicates, filters, cache, daemon,
+                                    options.parallel, refresh=options.refresh,
+                                    sync=options.sync, changes=options.changes,
+                                    full_sync_every=options.full_sync_every ):
+
+        row = table_row( i, details if options.join_volumes else None )
+        if multi_region:
+            row.insert( 1, region )
+        if options.changes:
+            row.insert( 1, i.get( 'change' ) )
+
+        write( row )
+
+        #PP.pprint( i )
+
+    with ec2stats.phase( 'render' ):
+        out.close()
+
+def main( argv=None ):
+    ( options, args ) = parser.parse_args( argv )
+
+    if options.stats:
+        ec2stats.enable()
+
+    ###################
+    ### Logging
+    ###################
+
+    if options.verbose: log_level = logging.DEBUG
+    else:               log_level = logging.INFO
+
+    logging.basicConfig(stream=sys.stdout, level=log_level)
+    logging.basicConfig(stream=sys.stderr, level=(logging.ERROR,logging.CRITICAL))
+
+    list_instances( options )
+
+    ### the output is incomplete; don't let a script take it for all there is
+    if FAILED_REGIONS:
+        sys.stderr.write( "failed: %s\n" % ', '.join( sorted( set( FAILED_REGIONS ) ) ) )
+        sys.exit( 1 )
 
 if __name__ == '__main__':
-    list_instances()
-
+    ### streaming formats get piped into head & co; die quietly when they exit
+    signal.signal( signal.SIGPIPE, signal.SIG_DFL )
+    main()
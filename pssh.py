@@ -1,26 +1,71 @@
 #!/usr/bin/env kpython
-# Parallel SSH to a list of nodes, returned from search-ec2-tags.py
-# (must be in your path).
+# Parallel SSH to a list of nodes, returned from a search-ec2-tags.py query
+# (ec2search.py must be importable, e.g. sitting next to this script).
+# --stats also needs ec2stats.py; without it, everything else still works.
 #
-# Waits for nodes to respond, then outputs their stdout,stderr color coded.
+# Outputs the stdout,stderr of each node color coded, as soon as it is done,
+# or with --stream, line by line as it comes in. --stream does not strip
+# the ssh warning banners from stderr.
 #
 # ./pssh.py --query 'ec2_tag' 'command_to_run'
 #
 # Options:
 #  -h, --help           show this help message and exit
-#  --query=QUERY        the string to pass search-ec2-tags.py
+#  --query=QUERY        search-ec2-tags.py style query for the hosts
 #  --hosts=HOSTS        comma-sep list of hosts to ssh to
 #  --no-color           disable or enable color
 #  --keep-ssh-warnings  disable the removing of SSH warnings from stderr output
 #  --connect-timeout    ssh ConnectTimeout option
-#  --timeout            amount of time to wait, before killing the ssh
+#  --timeout            seconds to wait on a host, before killing its ssh
+#  --total-timeout      seconds to wait on all hosts, before killing what is left
+#  --parallel           max number of ssh sessions at the same time
+#  --canary             run on this many hosts first, continue if they all succeed
+#  --batch              run on this many hosts at a time, stop after a failed batch
+#  --reuse              reuse pooled ssh connections (ControlMaster/ControlPersist)
+#  --pool               manage the connection pool: warm, list or close
+#  --ssh                ssh executable to use
+#  --stream             print output as it arrives, prefixed with the host
+#  --spool-max          bytes of output per host to keep in memory, before
+#                       spooling the rest to a temporary file
+#  --stats              write timings to stderr as JSON, with histograms of
+#                       the per host connect (time to first output) and run
+#                       latencies
 #
+# Connection pool: back to back runs with --reuse share one authenticated
+# connection per host, instead of paying for a new handshake every time.
+#
+# ./pssh.py --query 'ec2_tag' --pool warm      # connect to all of them now
+# ./pssh.py --query 'ec2_tag' --reuse 'uptime'
+# ./pssh.py --pool list                        # also removes stale sockets
+# ./pssh.py --pool close                       # or --query/--host to pick
+#
+import os
 import sys
 import time
+import errno
+import fcntl
+import itertools
+import tempfile
 import subprocess
 import select
+import threading
+import Queue
 from optparse import OptionParser
 
+try:
+    import ec2stats
+except ImportError:
+    ec2stats = None
+
+SEARCH_PARALLEL = 16        # regions to search at the same time
+SEARCH_REGION_TIMEOUT = 30  # seconds before giving up on a region
+READ_SIZE = 65536     # bytes to read from a pipe at a time
+STATUS_INTERVAL = 5   # seconds between "waiting on these hosts" messages
+DEFAULT_PARALLEL = 100  # ssh sessions in flight at the same time
+HALF_CLOSED_POLL = 0.1  # secs between exit checks on an ssh with one pipe open
+HOST_POLL = 0.1       # secs between checks for more hosts, while they come in
+POOL_DIR = os.path.expanduser('~/.ssh/pssh-pool')  # ControlMaster sockets
+
 
 def hilite(string, options, color='white', bold=False):
     if options.no_color:
@@ -39,48 +84,607 @@ def hilite(string, options, color='white', bold=False):
 
 
 def remove_ssh_warnings(stderr, options):
+    """
+    'stderr' (the start of it) without the warning ssh puts in front of it,
+    line endings and all, so what comes after can be written right behind.
+    """
     if options.keep_ssh_warnings:
         return stderr
 
-    output = str(stderr).splitlines()
-    if len(output) == 0:
-        return None
-    if len(output) == 1:
-        return output[0]
-
-    if stderr[0].startswith('@'):
+    output = str(stderr).splitlines(True)
+    if len(output) > 1 and output[0].startswith('@'):
         # 8 lines for a DNS spoofing warning
         if 'POSSIBLE DNS SPOOFING' in output[1]:
             output = output[8:]
         # 13 lines for a remote host identification changed warning
-        if 'REMOTE HOST IDENTIFICATION' in output[1]:
+        elif 'REMOTE HOST IDENTIFICATION' in output[1]:
             output = output[13:]
-    if len(output) == 0:
-        return None
-    if len(output) == 1:
-        return output[0]
-
-    return '\n'.join(output)
 
+    return ''.join(output)
+
+
+def query(string, options):
+    """
+    Generator of the hosts matching 'string' (search-ec2-tags.py syntax,
+    without --api: AND, OR and NOT are operators, daemon or not). Hosts come
+    in a region at a time, so the first sessions can start while the slower
+    regions are still being searched.
+    """
+    # a running inventory daemon knows already
+    from ec2daemon import Client
+    from ec2inventory import DEFAULT_TTL
+    answers = Client().search(string.split(), None, DEFAULT_TTL)
+    if answers is not None:
+        matched = [host for region in sorted(answers) for host in answers[region] if host]
+        for host in matched:
+            yield host
+        print "matched the following hosts: %s" % ', '.join(matched)
+        return
+
+    # only pay for importing boto when we have to search
+    from ec2inventory import InventoryCache
+    from ec2search import search
+
+    def error(region, error):
+        print hilite("Sorry, searching %s failed: %s" % (region.name, error), options, 'red')
+
+    matched = []
+    # query all regions at once, we pay this latency on every run
+    for host in search(string.split(), workers=SEARCH_PARALLEL,
+                       timeout=SEARCH_REGION_TIMEOUT, cache=InventoryCache(),
+                       errors=error, index=True):
+        matched.append(host)
+        yield host
+
+    print "matched the following hosts: %s" % ', '.join(matched)
+
+
+def control_path(options):
+    """
+    The ControlPath of the pool. %C is a hash of the local host, remote host,
+    port and user: it fits in a socket path (104-108 bytes) whatever the
+    host name, and ssh works it out from the name as given, aliases and all.
+    """
+    return os.path.join(options.pool_dir, '%C')
+
+
+def control_options(options):
+    """ssh options that route a session through the connection pool"""
+    return "-oControlMaster=auto -oControlPath=%s -oControlPersist=%d" % \
+        (control_path(options), options.control_persist)
+
+
+def pool_sockets(options):
+    """the paths of the control sockets in the pool"""
+    if not os.path.isdir(options.pool_dir):
+        return []
+    return [os.path.join(options.pool_dir, name)
+            for name in sorted(os.listdir(options.pool_dir))]
+
+
+def pool_control(options, path, cmd, host='pool'):
+    """
+    Send 'cmd' (check, exit) to the master behind a control socket; 'path'
+    may be control_path(), for ssh to pick the socket of 'host'. Returns
+    (succeeded?, what ssh said).
+    """
+    proc = subprocess.Popen([options.ssh, '-S', path, '-O', cmd, host],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.communicate()[0]
+    return proc.returncode == 0, output.strip()
+
+
+def pool_list(options):
+    """print the live connections in the pool, and clean up stale sockets"""
+    for path in pool_sockets(options):
+        alive, status = pool_control(options, path, 'check')
+        if alive:
+            # the socket is named by a hash; the master's pid is what ssh has to say
+            print "%s %s" % (hilite(path, options, 'green'), status)
+        else:
+            # the master is gone, ssh would refuse to reuse this path
+            os.unlink(path)
+            print "%s (stale, removed)" % hilite(path, options, 'red')
+
+
+def pool_close(options, hosts=None):
+    """tear down the pooled connections, to 'hosts' or all of them"""
+    if hosts:
+        for host in hosts:
+            if pool_control(options, control_path(options), 'exit', host)[0]:
+                print "closed %s" % host
+        return
+
+    for path in pool_sockets(options):
+        pool_control(options, path, 'exit')
+        if os.path.exists(path):
+            os.unlink(path)
+        print "closed %s" % path
+
+
+class Resolver(object):
+    """
+    The hosts of an iterable, e.g. query(), pulled out of it on a thread of
+    their own: get() never blocks for longer than asked, so the ssh sessions
+    in flight get read while a slow region is still being searched.
+    """
+    DONE = object()
+
+    def __init__(self, hosts):
+        self.queue = Queue.Queue()
+        self.ahead = []
+        self.error = None
+        self.done = False
+        if isinstance(hosts, (list, tuple)):
+            self.resolve(hosts)
+        else:
+            thread = threading.Thread(target=self.resolve, args=(hosts,))
+            thread.daemon = True
+            thread.start()
+
+    def resolve(self, hosts):
+        try:
+            for host in hosts:
+                self.queue.put(host)
+        except Exception:
+            self.error = sys.exc_info()
+        finally:
+            self.queue.put(self.DONE)
+
+    def get(self, timeout):
+        """
+        The next host, or None if it didn't come in within 'timeout' seconds
+        (0 doesn't wait at all). Raises StopIteration when there are no more.
+        """
+        if self.ahead:
+            return self.ahead.pop()
+        if self.done:
+            raise StopIteration
+        try:
+            host = self.queue.get(timeout > 0, max(timeout, 0) or None)
+        except Queue.Empty:
+            return None
+
+        if host is self.DONE:
+            self.done = True
+            if self.error:
+                raise self.error[0], self.error[1], self.error[2]
+            raise StopIteration
+        return host
+
+    def ready(self):
+        """the hosts that came in so far, without waiting for any more"""
+        hosts = []
+        try:
+            host = self.get(0)
+            while host is not None:
+                hosts.append(host)
+                host = self.get(0)
+        except StopIteration:
+            pass
+        return hosts
+
+    def wait(self):
+        """wait for the first host; False if there are none at all"""
+        try:
+            self.ahead.append(self.next())
+        except StopIteration:
+            return False
+        return True
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        # a timeout, as a blocking Queue.get() doesn't see a ^C in python 2
+        host = None
+        while host is None:
+            host = self.get(STATUS_INTERVAL)
+        return host
+
+
+class Poller(object):
+    """
+    Wait for any of a set of file descriptors to become readable. Uses poll()
+    where we have it, as select() tops out at 1024 descriptors, i.e. ~500 hosts.
+    """
+
+    def __init__(self):
+        self.fds = set()
+        if hasattr(select, 'poll'):
+            self.poll = select.poll()
+        else:
+            self.poll = None
+
+    def register(self, fd):
+        self.fds.add(fd)
+        if self.poll:
+            self.poll.register(fd, select.POLLIN | select.POLLPRI)
+
+    def unregister(self, fd):
+        self.fds.discard(fd)
+        if self.poll:
+            self.poll.unregister(fd)
+
+    def wait(self, timeout):
+        """returns the readable fds, waiting at most 'timeout' seconds"""
+        if self.poll:
+            try:
+                return [fd for fd, event in self.poll.poll(max(timeout, 0) * 1000)]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    return []
+                raise
+
+        if not self.fds:
+            time.sleep(max(timeout, 0))
+            return []
+        try:
+            return select.select(list(self.fds), [], [], max(timeout, 0))[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+
+class Session(object):
+    """
+    One ssh to one host, and everything it has written so far. Output is
+    kept in memory up to 'spool_max' bytes per stream, and spooled to a
+    temporary file past that (0 keeps it all in memory).
+    """
+
+    def __init__(self, host, proc, timeout=None, spool_max=0):
+        self.host = host
+        self.proc = proc
+        self.started = time.time()
+        self.finished = None
+        self.first_output = None
+        self.deadline = self.started + timeout if timeout else None
+        self.timed_out = False
+        self.returncode = None
+        self.output = {'stdout': tempfile.SpooledTemporaryFile(max_size=spool_max),
+                       'stderr': tempfile.SpooledTemporaryFile(max_size=spool_max)}
+        # what's left after the last newline, for --stream
+        self.partial = {'stdout': '', 'stderr': ''}
+        # fd -> (which stream it is, the pipe)
+        self.pipes = {proc.stdout.fileno(): ('stdout', proc.stdout),
+                      proc.stderr.fileno(): ('stderr', proc.stderr)}
+
+    def chunks(self, stream):
+        """the output of 'stream' so far, READ_SIZE bytes at a time"""
+        spool = self.output[stream]
+        spool.seek(0)
+        while True:
+            data = spool.read(READ_SIZE)
+            if not data:
+                break
+            yield data
+
+    def discard(self):
+        for spool in self.output.values():
+            spool.close()
+
+
+class Multiplexer(object):
+    """
+    Runs the ssh sessions, and reads all their pipes as data arrives, so no
+    remote command ever stalls on a full pipe buffer. Sessions are handed
+    back as soon as they finish, or once they ran past their deadline.
+    """
+
+    def __init__(self, command, options):
+        self.command = command
+        self.options = options
+        self.poller = Poller()
+        self.fds = {}       # fd -> session
+        self.running = []
+
+    def ssh_command(self, host):
+        ssh = "%s -oStrictHostKeyChecking=no -oConnectTimeout=%s" % \
+            (self.options.ssh, self.options.connect_timeout)
+        if self.options.reuse:
+            ssh += ' ' + control_options(self.options)
+        return "%s %s '%s'" % (ssh, host, self.command)
+
+    def start(self, host):
+        proc = subprocess.Popen(self.ssh_command(host), shell=True,
+                                stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+        session = Session(host, proc, self.options.timeout, self.options.spool_max)
+        for fd in session.pipes:
+            self.fds[fd] = session
+            self.poller.register(fd)
+        self.running.append(session)
+        return session
+
+    def close(self, session, fd):
+        self.poller.unregister(fd)
+        del self.fds[fd]
+        session.pipes.pop(fd)[1].close()
+
+    def drain(self, session):
+        """read whatever is left in the pipes, without blocking"""
+        for fd, (stream, pipe) in session.pipes.items():
+            # not select(): it can't take fds past FD_SETSIZE, see Poller
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            while True:
+                try:
+                    data = os.read(fd, READ_SIZE)
+                except OSError, e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        break
+                    raise
+                if not data:
+                    break
+                self.collect(session, stream, data)
+
+    def collect(self, session, stream, data):
+        """keep the output for later, or with --stream, print whole lines now"""
+        if session.first_output is None:
+            session.first_output = time.time()
+
+        if not self.options.stream:
+            session.output[stream].write(data)
+            return
+
+        lines = (session.partial[stream] + data).split('\n')
+        session.partial[stream] = lines.pop()
+        # no newline in sight; don't let a single line eat all our memory
+        if len(session.partial[stream]) > READ_SIZE:
+            lines.append(session.partial[stream])
+            session.partial[stream] = ''
+
+        for line in lines:
+            stream_line(session.host, stream, line, self.options)
+
+    def finish(self, session):
+        for fd in session.pipes.keys():
+            self.close(session, fd)
+        for stream, line in session.partial.items():
+            if line:
+                stream_line(session.host, stream, line, self.options)
+        session.returncode = session.proc.wait()
+        session.finished = time.time()
+        if ec2stats:
+            # no output at all: no telling when it got connected
+            if session.first_output:
+                ec2stats.observe('connect', session.first_output - session.started)
+            ec2stats.observe('run', session.finished - session.started)
+        self.running.remove(session)
+
+    def kill(self, session):
+        session.timed_out = True
+        try:
+            session.proc.terminate()
+        except OSError:
+            pass  # it exited in the meantime
+        self.finish(session)
+
+    def wait(self, timeout):
+        """
+        Wait at most 'timeout' seconds for activity, and return the sessions
+        that completed, or got killed for running too long, meanwhile.
+        """
+        done = []
+        now = time.time()
+        deadlines = [s.deadline for s in self.running if s.deadline]
+        if deadlines:
+            timeout = min(timeout, min(deadlines) - now)
+        if [s for s in self.running if len(s.pipes) < 2]:
+            timeout = min(timeout, HALF_CLOSED_POLL)
+
+        for fd in self.poller.wait(timeout):
+            session = self.fds[fd]
+            data = os.read(fd, READ_SIZE)
+            if data:
+                self.collect(session, session.pipes[fd][0], data)
+                continue
+
+            # EOF; once both pipes are closed, the ssh is done
+            self.close(session, fd)
+            if not session.pipes:
+                self.finish(session)
+                done.append(session)
+
+        # a ControlPersist master stays behind in the background, holding on
+        # to stderr; once the ssh itself has exited, don't wait for the EOF
+        for session in list(self.running):
+            if len(session.pipes) < 2 and session.proc.poll() is not None:
+                self.drain(session)
+                self.finish(session)
+                done.append(session)
+
+        now = time.time()
+        for session in list(self.running):
+            if session.deadline and now >= session.deadline:
+                self.kill(session)
+                done.append(session)
+
+        return done
+
+
+def stream_line(host, stream, line, options):
+    """print one line of output for --stream, prefixed with the host"""
+    if stream == 'stdout':
+        print "%s %s" % (hilite('[' + host + ']', options, bold=True),
+                         hilite(line, options, 'green', False))
+    else:
+        print "%s %s" % (hilite('[' + host + ']', options, bold=True),
+                         hilite(line, options, 'red', False))
+    sys.stdout.flush()
+
+
+def report(session, options):
+    """print the host and its results"""
+    if session.timed_out:
+        print "%s (took too long, and I gave up - here is the output so far)" % \
+            hilite('[' + session.host + ']', options, bold=True)
+    elif session.returncode:
+        print "%s (exit code %d)" % \
+            (hilite('[' + session.host + ']', options, bold=True), session.returncode)
+    elif options.stream:
+        print "%s done" % hilite('[' + session.host + ']', options, bold=True)
+    else:
+        print "[%s]" % hilite(session.host, options, bold=True)
+
+    # written out a chunk at a time, so a spooled host never needs to fit
+    # in memory
+    for index, chunk in enumerate(session.chunks('stdout')):
+        if index == 0:
+            sys.stdout.write("STDOUT: \n")
+        sys.stdout.write(hilite(chunk, options, 'green', False))
+    else:
+        if session.output['stdout'].tell():
+            sys.stdout.write("\n")
+
+    # any ssh warnings are at the very start
+    written = False
+    for index, chunk in enumerate(session.chunks('stderr')):
+        if index == 0:
+            chunk = remove_ssh_warnings(chunk, options)
+            # nothing but the warning (and a newline) in this chunk; there
+            # may well be more in the next one
+            if not chunk.strip():
+                continue
+        if not written:
+            sys.stdout.write("STDERR: \n")
+            written = True
+        sys.stdout.write(hilite(chunk, options, 'red', False))
+    if written:
+        sys.stdout.write("\n")
+
+    sys.stdout.flush()
+    session.discard()
+
+
+def run(mux, hosts, options, give_up_at=None):
+    """
+    Run the command on 'hosts' (a Resolver, or any iterable), with at most
+    options.parallel sessions in flight; the next host starts as soon as a
+    session finishes, or comes in. Returns the sessions that failed: a
+    non-zero exit code, or killed for taking too long.
+    """
+    if not isinstance(hosts, Resolver):
+        hosts = Resolver(hosts)
+    failed = []
+    more = True
+    next_status = time.time() + STATUS_INTERVAL
+
+    while True:
+        starved = False
+        while more and (not options.parallel or len(mux.running) < options.parallel):
+            try:
+                host = hosts.get(0)
+            except StopIteration:
+                more = False
+                break
+            if host is None:
+                starved = True
+                break
+            mux.start(host)
+
+        if not mux.running and not more:
+            break
 
-def query(string):
-    stdout, stderr = subprocess.Popen(['kpython', '/usr/local/bin/search-ec2-tags.py'] + string.split(),
-                                      stderr=subprocess.PIPE, stdout=subprocess.PIPE).communicate()
-    print "matched the following hosts: %s" % ', '.join(stdout.splitlines())
-    if stderr:
-        return ["Error: %s" % stderr,]
-    return stdout.splitlines()
+        timeout = next_status - time.time()
+        if give_up_at:
+            timeout = min(timeout, give_up_at - time.time())
+        if starved:
+            # room for more sessions: look for hosts coming in every now and then
+            timeout = min(timeout, HOST_POLL)
+
+        done = mux.wait(timeout)
+
+        now = time.time()
+        if give_up_at and now >= give_up_at:
+            for session in list(mux.running):
+                mux.kill(session)
+                done.append(session)
+
+            # don't start anybody else either, nor wait for the search
+            skipped = hosts.ready()
+            if skipped:
+                print hilite("\nOut of time, not running on: %s\n" % ','.join(skipped),
+                             options, 'red')
+            more = False
+
+        elif mux.running and now >= next_status:
+            # only print "waiting still.." every few secs.
+            print "waiting on these hosts, still: %s" % \
+                ', '.join([s.host for s in mux.running])
+            sys.stdout.flush()
+            next_status = now + STATUS_INTERVAL
+
+        for session in done:
+            report(session, options)
+            if session.timed_out or session.returncode:
+                failed.append(session)
+
+    return failed
+
+
+def batches(hosts, options):
+    """
+    Split the hosts up according to --canary and --batch: the canary hosts
+    first, then --batch hosts at a time, or everybody else in one go.
+    """
+    hosts = iter(hosts)
+    size = options.canary or options.batch
+    while size:
+        batch = list(itertools.islice(hosts, size))
+        if not batch:
+            return
+        yield batch
+        size = options.batch
+
+    yield hosts
 
 
 if __name__ == '__main__':
 
     parser = OptionParser(usage=__doc__)
-    parser.add_option("--query", help='the string to pass search-ec2-tags.py', default=False)
+    parser.add_option("--query", help='search-ec2-tags.py style query for the hosts', default=False)
     parser.add_option("--host", help='comma-sep list of hosts to ssh to', default=False)
-    parser.add_option("--timeout", help='amount of time to wait before killing the ssh',
+    parser.add_option("--timeout", type="float",
+                      help='seconds to wait on a host before killing its ssh',
                       default=240)
+    parser.add_option("--total-timeout", type="float",
+                      help='seconds to wait on all hosts, before killing what is left',
+                      default=None)
     parser.add_option("--connect-timeout", help='ssh ConnectTimeout option',
                       default=10)
+    parser.add_option("--parallel", type="int",
+                      help='max number of ssh sessions at the same time (0 for no limit)',
+                      default=DEFAULT_PARALLEL)
+    parser.add_option("--canary", type="int",
+                      help='run on this many hosts first, and only continue if they all succeed',
+                      default=0)
+    parser.add_option("--batch", type="int",
+                      help='run on this many hosts at a time, stopping after a batch with failures',
+                      default=0)
+    parser.add_option("--reuse", action="store_true",
+                      help='reuse pooled ssh connections (ControlMaster), opening them as needed',
+                      default=False)
+    parser.add_option("--pool", type="choice", choices=['warm', 'list', 'close'],
+                      help='manage the connection pool: warm (connect to the hosts), '
+                           'list (and clean up stale sockets), or close',
+                      default=None)
+    parser.add_option("--pool-dir", help='where the pooled connection sockets live',
+                      default=POOL_DIR)
+    parser.add_option("--control-persist", type="int",
+                      help='seconds an idle pooled connection stays open',
+                      default=600)
+    parser.add_option("--ssh", help='ssh executable to use', default='ssh')
+    parser.add_option("--stream", action="store_true",
+                      help='print output as it arrives, one line at a time, prefixed with the host',
+                      default=False)
+    parser.add_option("--spool-max", type="int",
+                      help='bytes of output to keep in memory per host, before '
+                           'spooling it to a temporary file (0 for no limit)',
+                      default=0)
+    parser.add_option("--stats", "--profile", action="store_true",
+                      help='write timings and per host latency histograms to stderr, as JSON',
+                      default=False)
     parser.add_option("--no-color", action="store_true", help="disable or enable color",
                       default=False)
     parser.add_option("--keep-ssh-warnings", action="store_true",
@@ -88,117 +692,69 @@ if __name__ == '__main__':
                       default=False)
     (options, args) = parser.parse_args()
 
-    procs = []
-    command = args[0]
+    if options.stats:
+        if ec2stats is None:
+            parser.error("--stats needs ec2stats.py next to this script")
+        ec2stats.enable()
+
+    if options.pool == 'list':
+        pool_list(options)
+        sys.exit(0)
 
-    hosts = []
+    if options.pool == 'close' and not (options.query or options.host):
+        pool_close(options)
+        sys.exit(0)
+
+    if options.pool == 'warm':
+        # open a master to every host; it stays behind for --control-persist secs
+        options.reuse = True
+        command = 'true'
+    elif options.pool != 'close':
+        command = args[0]
+
+    hosts = iter([])
     if options.query:
-        hosts = query(options.query)
-        if len(hosts) > 0 and hosts[0].startswith("Error"):
-            print hilite("Sorry, search-ec2-tags.py returned an error:\n %s" % hosts, options, 'red')
-            sys.exit(1)
+        # before anything is searched, rather than in the middle of it
+        from ec2index import parse, QueryError
+        try:
+            parse(options.query.split())
+        except QueryError, e:
+            parser.error("bad --query: %s" % e)
+        hosts = query(options.query, options)
 
     if options.host:
-        hosts = [host.strip() for host in hosts.split(',')]
+        hosts = iter([host.strip() for host in options.host.split(',')])
 
-    if len(hosts) == 0:
+    # wait for the first host only; the rest can keep coming in while we work
+    hosts = Resolver(hosts)
+    if not hosts.wait():
         print hilite("Sorry, search-ec2-tags.py returned zero results.", options, 'red')
         sys.exit(1)
 
-    for host in hosts:
-        proc = subprocess.Popen("ssh -oStrictHostKeyChecking=no -oConnectTimeout=%s %s '%s'" %
-                                (options.connect_timeout, host, command), shell=True,
-                                stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-        procs.append(proc)
-
-    index = 0
-    ticks = 0
-    too_long = False
-    while 1:
-        # nothing has returned, the first few secs, I bet.
-        if ticks < 2:
-            time.sleep(1)
-        if ticks > 60:
-            too_long = True
-
-        host = hosts[index]
-        proc = procs[index]
-
-        # has it finished? go ahead and print the host and results.
-        if not too_long and proc.poll() is not None:
-            stdout, stderr = proc.communicate()
-            print "[%s]" % hilite(host, options, bold=True)
-            if stdout:
-                print "STDOUT: \n%s" % hilite(stdout, options, 'green', False)
-
-            stderr = remove_ssh_warnings(stderr, options)
-            if stderr and len(stderr) > 1:
-                print "STDERR: \n%s" % hilite(stderr, options, 'red', False)
-            del procs[index]
-            del hosts[index]
-
-        elif not too_long and (ticks > 1) and (ticks % 5 == 0):
-            # only print "waiting still.." every 5 sec.
-            print "waiting on these hosts, still: %s" % ', '.join(hosts)
-            time.sleep(1)
-
-        if too_long:
-            # it has been too long. print stdout/stderr one line at a time, so people
-            # know what's happening, and aren't left waiting for timeout (and
-            # then they never see stdout/stderr).
-            print "%s (responding slowly - here is the output so far)" % \
-                hilite('[' + host + ']', options, bold=True)
-
-            while 1:
-                if proc.poll() is not None:
-                    break
+    if options.pool == 'close':
+        pool_close(options, list(hosts))
+        sys.exit(0)
 
-                if select.select([proc.stdout], [], [], 0)[0]:
-                    print "STDOUT: \n"
-                while select.select([proc.stdout], [], [], 0)[0]:
-                    stdout = proc.stdout.readline()
-                    sys.stdout.write(hilite(stdout, options, 'green', False))
+    if options.reuse and not os.path.isdir(options.pool_dir):
+        os.makedirs(options.pool_dir, 0700)
 
-                while select.select([proc.stderr], [], [], 0)[0]:
-                    stderr = remove_ssh_warnings(proc.stderr.readline(), options)
-                    if stderr is None:
-                        break
-                    print "STDERR: \n"
-                    sys.stdout.write(hilite(stderr, options, 'red', False))
+    mux = Multiplexer(command, options)
+    give_up_at = time.time() + options.total_timeout if options.total_timeout else None
 
-                if ticks > options.timeout:
-                    break
-                elif proc.poll() is not None:
-                    break
-                else:
-                    time.sleep(1)
-
-            # one final time, to flush buffers, if the call won't block (process has exited)
-            if proc.poll() is not None:
-                stdout = '\n'.join(proc.stdout.readlines())
-                if stdout:
-                    print "STDOUT: \n%s" % hilite(stdout, options,
-                                                  'green', False)
-                stderr = '\n'.join(proc.stderr.readlines())
-                if stderr:
-                    print "STDERR: \n%s" % hilite(stderr, options,
-                                                  'red', False)
-
-            # remove from queue
-            if proc.poll() is not None:
-                del procs[index]
-                del hosts[index]
-
-        ticks += 1
-
-        if len(procs) > index + 1:
-            index += 1
-        elif len(procs) == 0:
-            break
+    for batch in batches(hosts, options):
+        if ec2stats:
+            with ec2stats.phase('ssh'):
+                failed = run(mux, batch, options, give_up_at)
         else:
-            index = 0
+            failed = run(mux, batch, options, give_up_at)
 
-        if ticks > options.timeout:
-            [bad.terminate() for bad in procs]
-            print hilite("\nSorry, the following hosts took too long, and I gave up: %s\n" % ','.join(hosts), options, 'red')
-            break
+        too_slow = [session.host for session in failed if session.timed_out]
+        if too_slow:
+            print hilite("\nSorry, the following hosts took too long, and I gave up: %s\n" %
+                         ','.join(too_slow), options, 'red')
+
+        # a staged rollout stops at the first batch with a problem
+        if failed and (options.canary or options.batch):
+            print hilite("Stopping: %s failed, not running on the remaining hosts." %
+                         ','.join([session.host for session in failed]), options, 'red')
+            sys.exit(1)
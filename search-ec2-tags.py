@@ -11,6 +11,21 @@
 #
 # Will check every ec2 region, unless, e.g. --regions='us-east-1,eu-west-1'
 #
+# Use --parallel=N to query N regions at the same time; hostnames are printed
+# as each region finishes. A region that doesn't answer within
+# --region-timeout seconds (or fails) is skipped, with a warning on stderr,
+# and the exit status is 1, as the list of hosts isn't complete.
+#
+# Queries run against a local index of every instance's tags, built from a
+# snapshot of every instance (see ec2sync.py), which is fetched again when
+# it is older than --cache-ttl seconds, or with --refresh. With --api, every
+# region is asked with a filtered describe call instead, and the results
+# are cached for --cache-ttl seconds. --stats writes timings and API
+# request counts to stderr.
+#
+# If the inventory daemon (ec2daemon.py) is running, and synced less than
+# --cache-ttl seconds ago, it answers the query, without any API calls.
+#
 # Examples:
 #   ./search-ec2-tags.py s_classes:s_puppetmaster
 #   ./search-ec2-tags.py s_puppetmaster environment:production
@@ -21,6 +36,10 @@
 # AND'd. Sorry, that's a limitation of the API, and I only want to make one
 # API call to each region.
 #
+# Without --api, you can say what you mean instead: combine filters with
+# AND, OR, NOT and parentheses (quoted, for the shell). Filters next to
+# each other are AND'd, once there is an operator anywhere in the query.
+#
 # Examples:
 #    Return all nodes with tag s_class:s_puppetmaster AND nodes with either
 #    'production' or 'development' in the value of any tag.
@@ -32,10 +51,23 @@
 #   Return all nodes w/ tag=Name matching 'foo' and tag environment:production
 #   ./search-ec2-tags.py Name:foo environment:production
 #
-import boto.ec2
+#   Return all puppetmasters, except for those in staging
+#   ./search-ec2-tags.py s_classes:s_puppetmaster NOT environment:staging
+#
+#   Return all nodes w/ tag=Name matching 'foo' in production, and all 'bar's
+#   ./search-ec2-tags.py '(Name:foo environment:production) OR Name:bar'
+#
+import ec2stats
 import sys
 from optparse import OptionParser
 
+from ec2inventory import InventoryCache, DEFAULT_TTL
+from ec2search import get_regions, build_query, scan_regions, search_region
+import ec2index
+from ec2daemon import Client
+
+ec2stats.checkpoint('import')
+
 
 if __name__ == '__main__':
 
@@ -43,39 +75,74 @@ if __name__ == '__main__':
     parser.add_option("--regions",
                       help='ec2 regions to check, comman-sep string',
                       default=False)
+    parser.add_option("--parallel", type="int",
+                      help='number of regions to query at the same time',
+                      default=1)
+    parser.add_option("--region-timeout", type="float",
+                      help='seconds to wait on a single region before skipping it',
+                      default=30)
+    parser.add_option("--cache-ttl", type="int",
+                      help='reuse results fetched in the last N seconds (0 disables)',
+                      default=DEFAULT_TTL)
+    parser.add_option("--refresh", action="store_true",
+                      help='ignore the inventory cache, and query ec2',
+                      default=False)
+    parser.add_option("--api", action="store_true",
+                      help='ask the API for the matches, rather than the local index '
+                           '(no AND/OR/NOT)',
+                      default=False)
+    parser.add_option("--stats", "--profile", action="store_true",
+                      help='write timings and API request counts to stderr, as JSON',
+                      default=False)
     (options, args) = parser.parse_args()
 
-    ec2_regions = boto.ec2.regions()
+    if options.stats:
+        ec2stats.enable()
+
+    # a running inventory daemon has the index in memory already
+    if not (options.api or options.refresh):
+        answers = Client().search(args, options.regions.split(',') if options.regions else None,
+                                  options.cache_ttl)
+        if answers is not None:
+            for region in sorted(answers):
+                for name in answers[region]:
+                    print name
+            sys.exit(0)
 
-    if not options.regions:
-        regions = ec2_regions
+    with ec2stats.phase('regions'):
+        regions = get_regions(options.regions)
+
+    if options.api:
+        query, region_search = build_query(args), search_region
     else:
-        regions = [reg for reg in ec2_regions
-                   if reg.name in options.regions]
+        try:
+            query, region_search = ec2index.parse(args), ec2index.search_region
+        except ec2index.QueryError, e:
+            parser.error("bad query: %s" % e)
+
+    cache = InventoryCache(ttl=options.cache_ttl)
 
-    query = {}
-    for arg in args:
-        string = arg.split(':', 1)
-        if len(string) == 2:
-            tag, val = string
-            # not in the dict yet? good! Add it.
-            if "tag:%s" % tag not in query:
-                query.update({"tag:%s" % tag: ['*' + val + '*']})
-            else:
-            # already there? extend the val (array) with another item:
-                query['tag:%s' % tag] = query.get('tag:%s' % tag) + ['*' + val + '*']
-        else:
-            if 'tag-value' not in query:
-                query.update({'tag-value': ['*' + string[0] + '*']})
-            else:
-                query['tag-value'] = query.get('tag-value') + ['*' + string[0] + '*']
+    # a region we've never heard of is skipped too
+    skipped = [name for name in (options.regions or '').split(',')
+               if name and name not in [region.name for region in regions]]
+    for name in skipped:
+        sys.stderr.write("%s: unknown region\n" % name)
 
-    for region in regions:
-        # we don't have access to gov regions in AWS:
-        if '-gov-' in region.name:
+    for region, names, error in scan_regions(regions, query, options.parallel,
+                                             options.region_timeout,
+                                             cache, options.refresh,
+                                             region_search):
+        if error:
+            sys.stderr.write("%s: %s\n" % (region.name, error))
+            skipped.append(region.name)
             continue
-        ec2 = region.connect()
 
-        for res in ec2.get_all_instances(filters=query):
-            instance = res.instances[0]
-            print instance.tags.get('Name')
+        with ec2stats.phase('render'):
+            for name in names:
+                print name
+            # stream each region out as soon as it is done
+            sys.stdout.flush()
+
+    if skipped:
+        sys.stderr.write("skipped %s; these results are incomplete\n" % ', '.join(sorted(skipped)))
+        sys.exit(1)
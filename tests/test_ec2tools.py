@@ -0,0 +1,208 @@
+#
+# Tests for the parts of the tools that are easy to get subtly wrong: the
+# local tag search matching what the API would have, which include options
+# get pushed down to EC2 as filters, how --agg treats missing values, and
+# the rate limiter's AIMD.
+#
+#   python -m unittest discover -s tests
+#
+import os
+import sys
+import unittest
+from fnmatch import fnmatchcase
+from operator import itemgetter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import ec2aggregate
+from ec2aggregate import Aggregator, parse_group_by, parse_aggregates
+from ec2api import RegionLimiter, MIN_RATE
+from ec2filters import literal_values
+from ec2index import TagIndex, QueryError, parse, legacy_query, wildcards
+from ec2search import build_query
+
+ROWS = {
+    'i-1': {'tags': {'Name': 'web01', 'environment': 'production',
+                     's_classes': 's_web,s_base'}},
+    'i-2': {'tags': {'Name': 'web02', 'environment': 'staging',
+                     's_classes': 's_web,s_base'}},
+    'i-3': {'tags': {'Name': 'db01', 'environment': 'production',
+                     's_classes': 's_db,s_base'}},
+    'i-4': {'tags': {'Name': 'pm01', 'environment': 'development',
+                     's_classes': 's_puppetmaster'}},
+    'i-5': {'tags': {'Name': 'odd*one', 'environment': 'AND'}},
+    'i-6': {'tags': {}},
+}
+
+
+def api_matches(filters, row):
+    """what EC2 does with build_query()'s filters: values OR'd, filters AND'd"""
+    for name, patterns in filters.items():
+        if name == 'tag-value':
+            values = row['tags'].values()
+        else:
+            values = [row['tags'][name[4:]]] if name[4:] in row['tags'] else []
+        if not [value for value in values
+                for pattern in patterns if fnmatchcase(value, pattern)]:
+            return False
+    return True
+
+
+class LegacyQueryTest(unittest.TestCase):
+
+    QUERIES = [
+        [],
+        ['web'],
+        ['s_classes:s_web'],
+        ['s_classes:s_web', 's_classes:s_db'],
+        ['production', 's_classes:s_base'],
+        ['production', 'staging', 'Name:01'],
+        ['Name:web0?'],
+        ['Name:w*1'],
+        ['environment:prod', 'environment:dev', 'Name:01'],
+        ['nothing-has-this'],
+    ]
+
+    def test_parse_without_operators_is_legacy(self):
+        for args in self.QUERIES:
+            self.assertEqual(parse(args), legacy_query(args))
+
+    def test_same_results_as_the_api(self):
+        index = TagIndex(ROWS)
+        for args in self.QUERIES:
+            expected = set([id for id, row in ROWS.items()
+                            if api_matches(build_query(args), row)])
+            self.assertEqual(index.evaluate(parse(args)), expected, args)
+
+    def test_no_args_match_everything(self):
+        self.assertEqual(TagIndex(ROWS).evaluate(parse([])), set(ROWS))
+
+    def test_argument_with_spaces_is_one_filter(self):
+        self.assertEqual(parse(['web prod']), ('and', ('or', ('tag', None, 'web prod'))))
+
+    def test_operators(self):
+        index = TagIndex(ROWS)
+        self.assertEqual(index.evaluate(parse(['s_classes:s_base AND (staging OR Name:db)'])),
+                         set(['i-2', 'i-3']))
+        self.assertEqual(index.evaluate(parse(['Name:web', 'NOT', 'environment:staging'])),
+                         set(['i-1']))
+
+    def test_bad_expressions(self):
+        for args in (['(web'], ['web', 'AND'], ['OR', 'web'], ['web )']):
+            self.assertRaises(QueryError, parse, args)
+
+
+class WildcardTest(unittest.TestCase):
+
+    def test_plain_value(self):
+        self.assertEqual(wildcards('web01'), None)
+
+    def test_literals_between_wildcards(self):
+        regex, literals = wildcards('we*0?x')
+        self.assertEqual(literals, ['we', '0', 'x'])
+        self.assertTrue(regex.search('a-web-01x'))
+        self.assertFalse(regex.search('web-0x'))
+
+    def test_escaped(self):
+        regex, literals = wildcards('odd\\*one')
+        self.assertEqual(literals, ['odd*one'])
+        self.assertTrue(regex.search('odd*one'))
+        self.assertFalse(regex.search('oddXone'))
+
+    def test_index_lookup(self):
+        index = TagIndex(ROWS)
+        self.assertEqual(index.lookup('Name', 'w*1'), set(['i-1']))
+        self.assertEqual(index.lookup('Name', 'odd\\*'), set(['i-5']))
+        self.assertEqual(index.lookup(None, 'pr?d'), set(['i-1', 'i-3']))
+        # every trigram is there, not in that order
+        self.assertEqual(index.lookup('Name', 'b01web'), set())
+
+
+class LiteralValuesTest(unittest.TestCase):
+
+    def test_lower_case_fields(self):
+        self.assertEqual(literal_values('running', lower=True), ['*running*'])
+        self.assertEqual(literal_values('^Running$|stopped', lower=True),
+                         ['running', '*stopped*'])
+        self.assertEqual(literal_values('m1.small', lower=True), ['*m1.small*'])
+
+    def test_regexes_stay_client_side(self):
+        self.assertEqual(literal_values('run+ing', lower=True), None)
+        self.assertEqual(literal_values('web|', lower=True), None)
+
+    def test_case_sensitive_fields(self):
+        # the regex matches 'Web01' too, the filter wouldn't
+        self.assertEqual(literal_values('web'), None)
+        self.assertEqual(literal_values('foo.bar'), None)
+        self.assertEqual(literal_values('^123-45$'), ['123-45'])
+
+
+class AggregatorTest(unittest.TestCase):
+
+    FIELDS = dict([(name, itemgetter(name)) for name in ['zone', 'size']])
+
+    ROWS = [
+        {'zone': 'a', 'size': 10, 'tags': {'cost': '5'}},
+        {'zone': 'a', 'size': None, 'tags': {}},
+        {'zone': 'a', 'size': 30, 'tags': {'cost': ''}},
+        {'zone': 'b', 'size': None, 'tags': {'cost': '7'}},
+    ]
+
+    def aggregate(self, agg):
+        aggregator = Aggregator(parse_group_by('zone', self.FIELDS),
+                                parse_aggregates(agg, self.FIELDS), self.FIELDS)
+        for row in self.ROWS:
+            aggregator.add('us-east-1', row)
+        return aggregator.rows()
+
+    def check(self):
+        # count counts every resource; the rest only those with the field
+        self.assertEqual(self.aggregate('count,sum(size),avg(size),min(size),max(size)'),
+                         [['a', 3, 40, 20, 10, 30],
+                          ['b', 1, None, None, None, None]])
+        self.assertEqual(self.aggregate('avg(tag:cost),max(tag:cost)'),
+                         [['a', 5, 5], ['b', 7, 7]])
+
+    def test_missing_values(self):
+        self.check()
+
+    def test_missing_values_without_numpy(self):
+        numpy = ec2aggregate.numpy
+        ec2aggregate.numpy = None
+        try:
+            self.check()
+        finally:
+            ec2aggregate.numpy = numpy
+
+    def test_not_a_number(self):
+        self.assertRaises(ec2aggregate.AggregateError, self.aggregate, 'sum(zone)')
+
+
+class RegionLimiterTest(unittest.TestCase):
+
+    def test_aimd(self):
+        limiter = RegionLimiter(rate=10, burst=5, concurrency=4)
+        limiter.acquire()
+        limiter.release()
+        self.assertTrue(limiter.rate > 10)
+        self.assertTrue(limiter.concurrency > 4)
+        self.assertEqual(limiter.in_flight, 0)
+
+        rate, concurrency = limiter.rate, limiter.concurrency
+        limiter.acquire()
+        limiter.release(throttled=True)
+        self.assertEqual(limiter.rate, rate / 2)
+        self.assertEqual(limiter.concurrency, concurrency / 2)
+        self.assertEqual(limiter.throttled, 1)
+        self.assertTrue(limiter.tokens <= 0)
+
+    def test_floor(self):
+        limiter = RegionLimiter(rate=MIN_RATE, burst=1, concurrency=1)
+        limiter.acquire()
+        limiter.release(throttled=True)
+        self.assertEqual(limiter.rate, MIN_RATE)
+        self.assertEqual(limiter.concurrency, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
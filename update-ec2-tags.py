@@ -10,42 +10,260 @@
 #
 # Caveat: EC2 only allows 255 chars for the value. You must limit the number of
 # classes you shove in the 'puppet_classes' key. See the two vars below the imports.
+#
+# This runs on every instance, so it goes out of its way not to get the
+# account throttled: the last published tags are kept in a state file, and
+# if nothing changed since, no API call is made at all (until --max-age
+# passes, in case somebody edited the tags by hand). The instance id and
+# region are remembered as well, for as long as the instance stays up.
+# When there is something to publish, we first sleep a random bit of
+# --jitter seconds, so a fleet on the same cron schedule doesn't hit the
+# API all at once, and back off exponentially when we get throttled anyway.
+#
+# Collector mode: rather than every instance calling the API itself, run
+# instances with --spool=DIR, which leaves their tags in DIR (e.g. a shared
+# mount) without needing AWS credentials, and run --collect=DIR from one
+# place. It tags all instances with identical tags in a single call. Files
+# of instances that no longer exist are dropped, as are files older than
+# --expire days (keep that above the instances' --max-age, after which they
+# spool their tags again, even when unchanged).
+#
+# This script can be deployed to the instances on its own: with ec2api.py
+# and ec2stats.py next to it, API calls are rate limited and retried with
+# backoff while throttled (and --stats works); without them, it falls back
+# to plain boto, and its own retries.
+#
 import boto.ec2
+import boto.utils
+import boto.exception
 import sys
+import os
+import json
+import time
+import re
+import random
 import collections
 import yaml
+from optparse import OptionParser
+
+try:
+    import ec2stats
+    from ec2api import connect
+except ImportError:
+    ec2stats = None
+
+    def connect(region, attempts, backoff):
+        """
+        Without ec2api: a plain boto connection, which retries a throttled
+        (503) request with its own backoff, 'attempts' times in total.
+        """
+        conn = boto.ec2.connect_to_region(region)
+        if conn is None:
+            raise ValueError("unknown region %s" % region)
+        conn.num_retries = max(attempts - 1, 0)
+        return conn
 
 puppet_class_tag_key = 's_classes'
 puppet_class_tag_val_startswith = 's_'  # the classes we care about start with s_*
 puppet_class_tag_ignore = 'params'  # if it has that string, don't care
 facts_yaml = '/mnt/tmp/facts.yaml'
+state_file = '/var/tmp/update-ec2-tags.json'
+boot_id_file = '/proc/sys/kernel/random/boot_id'
+collect_batch_size = 500  # instances per create_tags call in --collect
+instance_id_re = re.compile(r'\bi-[0-9a-f]+\b')
 
 
-def get_current_region():
+def get_current_region(metadata):
+    """
+    Return the region this instance is placed in, from its instance metadata.
     """
-    Query the instance metadata service and return the region this instance is
-    placed in.
-     """
-    return boto.utils.get_instance_metadata()['placement']['availability-zone'].strip().lower()[:-1]
+    return metadata['placement']['availability-zone'].strip().lower()[:-1]
 
 
-if __name__ == '__main__':
-    tags_dict = {}
+def get_boot_id():
+    """
+    Something that changes when the instance reboots, or a new instance is
+    launched from an image of this one.
+    """
+    try:
+        with open(boot_id_file) as fh:
+            return fh.read().strip()
+    except IOError:
+        return None
 
-    with open(facts_yaml) as fh:
-        puppet = yaml.safe_load(fh)
 
-    regions = boto.ec2.regions()
+def load_state():
+    try:
+        with open(state_file) as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return {}
 
-    region = [region for region in regions if get_current_region() in region.name][0]
-    instance_id = boto.utils.get_instance_metadata()['instance-id']
 
-    ec2 = region.connect()
+def save_state(state):
+    # write and rename, so a run that dies halfway doesn't leave a broken file
+    tmp = '%s.%d' % (state_file, os.getpid())
+    with open(tmp, 'w') as fh:
+        json.dump(state, fh)
+    os.rename(tmp, state_file)
 
-    res = ec2.get_all_instances(filters={'instance-id': instance_id})[0]
-    instance = res.instances[0]
 
-    #print instance.tags.get('Name'), instance.id, instance.placement
+def get_identity(state):
+    """
+    The (instance id, region) of this instance. Cached in the state file for
+    as long as the boot id stays the same, so we only ask the metadata
+    service once per boot.
+    """
+    boot_id = get_boot_id()
+    if boot_id and state.get('boot_id') == boot_id \
+            and state.get('instance_id') and state.get('region'):
+        return state['instance_id'], state['region']
+
+    metadata = boto.utils.get_instance_metadata()
+    state.update({'boot_id': boot_id,
+                  'instance_id': metadata['instance-id'],
+                  'region': get_current_region(metadata)})
+    return state['instance_id'], state['region']
+
+
+def spool(directory, instance_id, region, tags_dict):
+    """
+    Leave our tags in the spool directory, for --collect to publish.
+    """
+    path = os.path.join(directory, '%s.json' % instance_id)
+    # write and rename, so the collector never reads half a file
+    tmp = os.path.join(directory, '.%s.%d' % (instance_id, os.getpid()))
+    with open(tmp, 'w') as fh:
+        json.dump({'instance_id': instance_id, 'region': region, 'tags': tags_dict}, fh)
+    os.rename(tmp, path)
+
+
+def unlink_spooled(path, inode):
+    """remove a spool file, unless the instance dropped a newer one meanwhile"""
+    try:
+        if os.stat(path).st_ino == inode:
+            os.unlink(path)
+    except OSError:
+        pass
+
+
+def missing_instances(error):
+    """the instance ids an InvalidInstanceID.NotFound error complains about"""
+    if error.error_code != 'InvalidInstanceID.NotFound':
+        return set()
+    return set(instance_id_re.findall(error.error_message or ''))
+
+
+def collect(directory, options):
+    """
+    Publish everything in the spool directory: instances with identical
+    tags (in the same region) get them in one create_tags call, up to
+    collect_batch_size instances at a time. Files of instances that are
+    gone, or older than options.expire days, are removed.
+    """
+    expire_before = time.time() - options.expire * 86400
+    groups = collections.defaultdict(list)
+    for name in os.listdir(directory):
+        if name.startswith('.') or not name.endswith('.json'):
+            continue
+
+        path = os.path.join(directory, name)
+        try:
+            # remember which version of the file we read; an instance may
+            # drop a newer one while we work
+            stat = os.stat(path)
+            if stat.st_mtime < expire_before:
+                sys.stderr.write("expiring %s, not updated in %g days\n" %
+                                 (path, options.expire))
+                unlink_spooled(path, stat.st_ino)
+                continue
+            with open(path) as fh:
+                entry = json.load(fh)
+        except (IOError, OSError, ValueError), e:
+            sys.stderr.write("skipping %s: %s\n" % (path, e))
+            continue
+
+        key = (entry['region'], tuple(sorted(entry['tags'].items())))
+        groups[key].append((entry['instance_id'], path, stat.st_ino))
+
+    for (region, tags), entries in groups.items():
+        # rate limited, and retried with backoff while throttled
+        ec2 = connect(region, options.attempts, options.backoff)
+
+        for idx in range(0, len(entries), collect_batch_size):
+            batch = entries[idx:idx + collect_batch_size]
+            while batch:
+                try:
+                    ec2.create_tags([instance_id for instance_id, path, inode in batch],
+                                    dict(tags))
+                except boto.exception.EC2ResponseError, e:
+                    # one terminated instance fails the whole call: drop
+                    # its file, and try again without it
+                    missing = missing_instances(e)
+                    gone = [entry for entry in batch if entry[0] in missing]
+                    if not gone:
+                        # leave the files, we'll try again next time
+                        sys.stderr.write("%s: failed to tag %d instances: %s\n" %
+                                         (region, len(batch), e))
+                        break
+
+                    sys.stderr.write("%s: dropping instances that are gone: %s\n" %
+                                     (region, ', '.join([entry[0] for entry in gone])))
+                    for instance_id, path, inode in gone:
+                        unlink_spooled(path, inode)
+                    batch = [entry for entry in batch if entry[0] not in missing]
+                    continue
+
+                for instance_id, path, inode in batch:
+                    unlink_spooled(path, inode)
+                break
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage=__doc__)
+    parser.add_option("--jitter", type="float",
+                      help='sleep up to this many seconds before calling the API',
+                      default=60)
+    parser.add_option("--max-age", type="float",
+                      help='republish unchanged tags after this many seconds',
+                      default=86400)
+    parser.add_option("--attempts", type="int",
+                      help='times to try create_tags when throttled',
+                      default=5)
+    parser.add_option("--backoff", type="float",
+                      help='most seconds to back off after the first throttled attempt, '
+                           'doubling every time',
+                      default=2)
+    parser.add_option("--force", action="store_true",
+                      help='publish even if nothing changed',
+                      default=False)
+    parser.add_option("--spool",
+                      help="don't call the API, leave the tags in this directory for --collect",
+                      default=None)
+    parser.add_option("--collect",
+                      help='publish the tags all instances left in this spool directory',
+                      default=None)
+    parser.add_option("--expire", type="float",
+                      help='with --collect, remove spool files older than this many days',
+                      default=7)
+    parser.add_option("--stats", "--profile", action="store_true",
+                      help='write timings and API request counts to stderr, as JSON',
+                      default=False)
+    (options, args) = parser.parse_args()
+
+    if options.stats:
+        if ec2stats is None:
+            parser.error("--stats needs ec2stats.py next to this script")
+        ec2stats.enable()
+
+    if options.collect:
+        collect(options.collect, options)
+        sys.exit(0)
+
+    tags_dict = {}
+
+    with open(facts_yaml) as fh:
+        puppet = yaml.safe_load(fh)
 
     s_classes = ','.join([str(classes) for classes in puppet['krux_classes'].split()
                           if classes.startswith(puppet_class_tag_val_startswith)
@@ -59,5 +277,37 @@ if __name__ == '__main__':
     # cluster name!
     tags_dict.update({'cluster_name': puppet.get('cluster_name')[-254:]})
 
+    state = load_state()
+    instance_id, region = get_identity(state)
+
+    # what we published, or with --spool, left for the collector; kept apart,
+    # as spooled tags aren't published until a --collect gets them through
+    if options.spool:
+        tags_key, for_key, at_key = 'spooled_tags', 'spooled_for', 'spooled_at'
+    else:
+        tags_key, for_key, at_key = 'tags', 'published_for', 'published_at'
+
+    # nothing changed? then there's nothing to tell the API
+    if not options.force and state.get(tags_key) == tags_dict \
+            and state.get(for_key) == instance_id \
+            and time.time() - state.get(at_key, 0) < options.max_age:
+        save_state(state)
+        sys.exit(0)
+
+    if options.spool:
+        spool(options.spool, instance_id, region, tags_dict)
+        state.update({tags_key: tags_dict, for_key: instance_id, at_key: time.time()})
+        save_state(state)
+        sys.exit(0)
+
+    if options.jitter:
+        time.sleep(random.uniform(0, options.jitter))
+
+    # retried with backoff while throttled, see ec2api
+    ec2 = connect(region, options.attempts, options.backoff)
+
     # make the API call:
-    ec2.create_tags([instance.id], tags_dict)
+    ec2.create_tags([instance_id], tags_dict)
+
+    state.update({tags_key: tags_dict, for_key: instance_id, at_key: time.time()})
+    save_state(state)
@@ -1,15 +1,37 @@
 #!python
 
-import re
+### Also a library; importing it has no side effects, and boto is only
+### imported once there's ec2 to talk to:
+###
+###   from optparse import Values
+###   from volumes import get_volumes, volume_filters
+###
+###   predicates, filters = volume_filters( Values( { 'zone': 'us-east-1a' } ) )
+###   for region, v in get_volumes( [ 'us-east-1' ], predicates, filters ):
+###       ...
+###
 import sys
+import signal
+import json
+import itertools
 import logging
 
-import boto.ec2
-
-from texttable  import Texttable
+import ec2stats
+import ec2aggregate
+
+from ec2api       import connect
+from ec2daemon    import Client
+from ec2filters   import server_filters, compile_predicates, matches, tag
+from ec2inventory import InventoryCache, DEFAULT_TTL, DEFAULT_WORKERS, cached, \
+                         region_names, fetch_regions, iter_volumes, VolumeRow
+from ec2output    import FORMATS, writer
+from ec2sync      import VOLUMES, FULL_SYNC_INTERVAL, synced, region_failed, FAILED_REGIONS
+from operator   import itemgetter
 from pprint     import PrettyPrinter
 from optparse   import OptionParser
 
+ec2stats.checkpoint( 'import' )
+
 PP = PrettyPrinter( indent=2 )
 
 ###################
@@ -22,9 +44,29 @@ parser.add_option(  "-v", "--verbose",      default=None, action="store_true",
 parser.add_option(  "-H", "--no-header",    default=None, action="store_true",
                     help="suppress table header" )
 parser.add_option(  "-i", "--instance-name",default=None, action="store_true",
-                    help="Show instance names in attachment info (SLOW!)" )
+                    help="Show instance names in attachment info" )
+parser.add_option(  "-f", "--format",       default='table', type="choice", choices=FORMATS,
+                    help="output format: %s (default: table)" % ', '.join( FORMATS ) )
 parser.add_option(  "-r", "--region",       default='us-east-1',
-                    help="ec2 region to connect to" )
+                    help="ec2 region(s) to connect to: comma-sep, or 'all'" )
+parser.add_option(  "-p", "--parallel",     default=DEFAULT_WORKERS, type="int",
+                    help="number of regions to fetch at the same time" )
+parser.add_option(  "--cache-ttl",          default=DEFAULT_TTL, type="int",
+                    help="reuse inventory fetched in the last N seconds (0 disables)" )
+parser.add_option(  "--refresh",            default=None, action="store_true",
+                    help="ignore the inventory cache, and fetch from ec2" )
+parser.add_option(  "--sync",               default=None, action="store_true",
+                    help="keep a local snapshot, and only fetch what changed since the last run" )
+parser.add_option(  "--full-sync-every",    default=FULL_SYNC_INTERVAL, type="int",
+                    help="with --sync, fetch everything every N seconds (--refresh: now)" )
+parser.add_option(  "--changes",            default=None, action="store_true",
+                    help="with --sync, only show what was added (+), removed (-) or changed (~)" )
+parser.add_option(  "--group-by",         default=None,
+                    help="only show these fields' groups, comma-sep (e.g. zone,type; region, tag:Key)" )
+parser.add_option(  "--agg",                default=None,
+                    help="with --group-by, what to show per group: count, sum(field), avg(), min(), max() (default: count)" )
+parser.add_option(  "--stats", "--profile", default=None, action="store_true",
+                    help="write timings and API request counts to stderr, as JSON" )
 parser.add_option(  "-n", "--name",         default=None,
                     help="Include volumes with these names only (regex)" )
 parser.add_option(  "-N", "--exclude-name", default=None,
@@ -39,144 +81,229 @@ parser.add_option(  "-D", "--exclude-device", default=None,
                     help="Exclude volumes attached to these devices (regex)" )
 
 
-(options, args) = parser.parse_args()
-
-###################
-### Logging
-###################
-
-if options.verbose: log_level = logging.DEBUG
-else:               log_level = logging.INFO
-
-logging.basicConfig(stream=sys.stdout, level=log_level)
-logging.basicConfig(stream=sys.stderr, level=(logging.ERROR,logging.CRITICAL))
-
-
 ###################
-### Connection
+### Filters
 ###################
 
-conn = boto.ec2.connect_to_region( options.region )
+### most selective first, see compile_predicates()
+FIELDS = [
+    ( 'name',   tag( 'Name' ) ),
+    ( 'device', lambda v: v[ 'device' ] or '' ),
+    ( 'zone',   itemgetter( 'zone' ) ),
+]
+
+### include options that are simple enough to let ec2 do the filtering;
+### the predicates still run on whatever comes back
+SERVER_FILTERS = {
+    'name':   ( 'tag:Name',           False ),
+    'zone':   ( 'availability-zone',  True ),
+    'device': ( 'attachment.device',  True ),
+}
+
+def volume_filters( options ):
+    """( predicates, server side filters ) for the include/exclude options
+       (name, device, zone, and their exclude_*) set on 'options', e.g.
+       optparse.Values( { 'zone': 'us-east-1a' } )."""
+    return compile_predicates( options, FIELDS ), server_filters( options, SERVER_FILTERS )
+
+### the fields --group-by and --agg know, besides 'region' and 'tag:Key'
+AGG_FIELDS = dict( FIELDS + [
+    ( 'id',       itemgetter( 'id' ) ),
+    ( 'status',   itemgetter( 'status' ) ),
+    ( 'type',     itemgetter( 'type' ) ),
+    ( 'size',     itemgetter( 'size' ) ),
+    ( 'instance', lambda v: v[ 'instance_id' ] or '' ),
+] )
 
 ###################
-### Regexes
+### Fetching
 ###################
 
-regexes = {}
-for opt in [ 'name', 'exclude_name', 'zone', 'exclude_zone',
-             'device', 'exclude_device' ]:
-
-    ### we have a regex we should build
-    if options.__dict__.get( opt, None ):
-        regexes[ opt ] = re.compile( options.__dict__.get( opt ), re.IGNORECASE )
-
-#PP.pprint( regexes )
-
-def get_volumes():
-    volumes = conn.get_all_volumes()
-    rv      = [];
-
-    for v in volumes:
-
-        ### we will assume this node is one of the nodes we want
-        ### to operate on, and we will unset this flag if any of
-        ### the criteria fail
-        wanted_node = True
-
-        for re_name, regex in regexes.iteritems():
-
-            ### What's the value we will be testing against?
-            if re.search( 'name', re_name ):
-                value = v.tags.get( 'Name', '' )
-            elif re.search( 'zone', re_name ):
-                ### i.region is an object. i._placement is a string.
-                value = v.zone
-            elif re.search( 'device', re_name ):
-                value = v.attach_data.device or ''
-            else:
-                logging.error( "Don't know what to do with: %s" % re_name )
-                continue
-
-            #PP.pprint( "name = %s value = %s pattern = %s" % ( re_name, value, regex.pattern ) )
-
-            ### Should the regex match or not match?
-            if re.search( 'exclude', re_name ):
-                rv_value = None
-            else:
-                rv_value = True
-
-            ### if the match is not what we expect, then clearly we
-            ### don't care about the node
-            result = regex.search( value )
-
-            ### we expected to get no results, excellent
-            if result == None and rv_value == None:
-                pass
-
-            ### we expected to get some match, excellent
-            elif result is not None and rv_value is not None:
-                pass
-
-            ### we don't care about this node
-            else:
-                wanted_node = False
-                break
-
-        if wanted_node:
-            rv.append( v )
+### how many instance ids to describe per API call
+INSTANCE_BATCH_SIZE = 200
+
+def fetch_volumes( region, filters=None, cache=None, daemon=None, refresh=False,
+                   sync=False, full_sync_every=FULL_SYNC_INTERVAL, changes=False ):
+    """The volume rows of one region: from the inventory daemon if there
+       is one, from the cache if it's fresh enough, or with server side
+       'filters' from ec2. With 'sync', from the synced snapshot instead,
+       see synced()."""
+    ### the inventory daemon has it all in memory, if it's running, and
+    ### synced no longer than the cache ttl ago
+    if daemon and cache and not ( sync or refresh ):
+        rows = daemon.rows( 'volumes', region, cache.ttl )
+        if rows is not None:
+            return rows
+
+    ### a connection per region (and thread); boto's aren't thread safe
+    conn = connect( region )
+
+    if sync:
+        return synced( conn, region, VOLUMES, cache, full_sync_every, refresh, changes )
+
+    return cached( cache, region, 'volumes', VolumeRow,
+                   lambda: iter_volumes( conn, filters or None ),
+                   key=json.dumps( filters, sort_keys=True ) if filters else '',
+                   refresh=refresh )
+
+def get_volumes( regions, predicates=(), filters=None, cache=None, daemon=None,
+                 workers=DEFAULT_WORKERS, errors=region_failed, **kwargs ):
+    """Generator of ( region, volume ) for the volumes matching the
+       'predicates' (see volume_filters()), in all 'regions', fetched
+       'workers' regions at a time. Other keyword arguments go to
+       fetch_volumes()."""
+    fetch = lambda region: fetch_volumes( region, filters, cache, daemon, **kwargs )
+
+    ### with --stats, count what comes in and what makes it through
+    keep = ec2stats.timed( 'filter', matches )
+    rows = ec2stats.counted( fetch_regions( regions, fetch, workers, errors ), 'scanned' )
+    return ec2stats.counted( ( ( region, v ) for region, v in rows
+                                if keep( v, predicates ) ), 'kept' )
+
+def get_instance_names( region, instance_ids, cache=None, daemon=None, refresh=False ):
+    """Return a dict of instance id -> Name tag, from the inventory daemon
+       if there is one, or using one describe call per INSTANCE_BATCH_SIZE
+       instances, rather than one per volume."""
+    if daemon and cache and not refresh:
+        rv = daemon.names( region, instance_ids, cache.ttl )
+        if rv is not None:
+            return rv
+
+    conn            = connect( region )
+    instance_ids    = sorted( set( instance_ids ) )
+    rv              = {}
+
+    for idx in range( 0, len( instance_ids ), INSTANCE_BATCH_SIZE ):
+        ### filter rather than instance_ids=, so an id that has gone away
+        ### since the volumes were listed doesn't fail the whole batch
+        batch = instance_ids[ idx : idx + INSTANCE_BATCH_SIZE ]
+        for r in conn.get_all_instances( filters={ 'instance-id': batch } ):
+            for i in r.instances:
+                rv[ i.id ] = i.tags.get( 'Name', i.id )
 
     return rv
 
-def list_volumes():
-    table       = Texttable( max_width=0 )
-
-    table.set_deco( Texttable.HEADER )
-    table.set_cols_dtype( [ 't', 't', 't', 't', 't', 't', 't' ] )
-    table.set_cols_align( [ 'l', 'l', 'l', 'l', 'l', 'l', 'l' ] )
-
-    if not options.no_header:
-        ### using add_row, so the headers aren't being centered, for easier grepping
-        table.add_row([ '# id', 'Name', 'Zone', 'Status', 'Size', 'Instance', 'Device' ])
-
-    volumes = get_volumes()
-    for v in volumes:
-        ad = v.attach_data
-
-        if ad.instance_id:
-            if options.instance_name:
-                i       = conn.get_all_instances(
-                            instance_ids=[ ad.instance_id ] )[0].instances[ 0 ]
-                name    = i.tags.get('Name', i.id )
-            else:
-                name    = ad.instance_id
-        else:
-            name    = '-'
-
-        table.add_row( [ v.id, v.tags.get( 'Name', ' ' ), v.zone , v.status,
-                         v.size, name or '-' , ad.device or '-' ] )
-
-        #PP.pprint(  )
-
-
-        """
-        ### XXX there's a bug where you can't get the size of the volumes, it's
-        ### always reported as None :(
-        volumes = ", ".join( [ ebs.volume_id for ebs in i.block_device_mapping.values()
-                                if ebs.delete_on_termination == False ] )
-
-        ### you can use i.region instead of i._placement, but it pretty
-        ### prints to RegionInfo:us-east-1. For now, use the private version
-        ### XXX EVERY column in this output had better have a non-zero length
-        ### or texttable blows up with 'width must be greater than 0' error
-        table.add_row( [ i.id, i.tags.get( 'Name', ' ' ), i.instance_type,
-                         i._placement , i.groups[0].name, volumes or ' ' ] )
-
-        #PP.pprint( i.__dict__ )
-        """
-
-    ### table.draw() blows up if there is nothing to print
-    if volumes or not options.no_header:
-        print table.draw()
+### ( key, title, shown in the table when empty ), see ec2output
+COLUMNS = [ ( 'id',         '# id',     ' ' ),
+            ( 'name',       'Name',     ' ' ),
+            ( 'zone',       'Zone',     ' ' ),
+            ( 'status',     'Status',   ' ' ),
+            ( 'size',       'Size',     ' ' ),
+            ( 'instance',   'Instance', '-' ),
+            ( 'device',     'Device',   '-' ) ]
+REGION_COLUMN = ( 'region', 'Region', ' ' )
+CHANGE_COLUMN = ( 'change', 'Change', ' ' )
+
+### with streaming output formats, look up instance names for this
+### many volumes at a time, rather than waiting for all of them
+STREAM_CHUNK_SIZE = 1000
+
+def named_volumes( volumes, chunk_size=None, names=None ):
+    """Generator of ( region, volume, what to show as its instance ) for
+       the ( region, volume )s in 'volumes'. With 'names', a function of
+       ( region, instance ids ) returning a dict of id -> name (see
+       get_instance_names()), it's the instance's name rather than its id,
+       looked up in bulk for 'chunk_size' volumes at a time, or for all of
+       them at once if that's None."""
+    found   = {}
+    volumes = iter( volumes )
+
+    while True:
+        chunk = list( itertools.islice( volumes, chunk_size ) )
+        if not chunk:
+            break
+
+        if names:
+            wanted = {}
+            for region, v in chunk:
+                if v['instance_id'] and v['instance_id'] not in found:
+                    wanted.setdefault( region, [] ).append( v['instance_id'] )
+
+            for region, instance_ids in wanted.items():
+                found.update( names( region, instance_ids ) )
+
+        for region, v in chunk:
+            yield region, v, found.get( v['instance_id'], v['instance_id'] )
+
+def list_volumes( options ):
+    regions     = region_names( options.region )
+    cache       = InventoryCache( ttl=options.cache_ttl )
+    daemon      = Client()
+    predicates, filters = volume_filters( options )
+    aggregator  = ec2aggregate.grouping( options, AGG_FIELDS, parser )
+
+    if aggregator:
+        ec2aggregate.summarize( options, aggregator,
+                    get_volumes( regions, predicates, filters, cache, daemon,
+                                 options.parallel, refresh=options.refresh,
+                                 sync=options.sync, changes=options.changes,
+                                 full_sync_every=options.full_sync_every ),
+                    parser )
+        return
+
+    ### with more than one region, say which one every row came from
+    multi_region = len( regions ) > 1
+
+    columns = COLUMNS
+    if multi_region:
+        ### right after the id; '# id' stays in front, for easier grepping
+        columns = COLUMNS[ :1 ] + [ REGION_COLUMN ] + COLUMNS[ 1: ]
+    if options.changes:
+        columns = columns[ :1 ] + [ CHANGE_COLUMN ] + columns[ 1: ]
+
+    out = writer( options.format, columns, header=not options.no_header )
+    write = ec2stats.timed( 'render', out.write )
+
+    ### the table can't print before it has every row anyway
+    chunk_size = None if options.format == 'table' else STREAM_CHUNK_SIZE
+
+    names = None
+    if options.instance_name:
+        names = lambda region, instance_ids: get_instance_names(
+                    region, instance_ids, cache, daemon, options.refresh )
+
+    volumes = get_volumes( regions, predicates, filters, cache, daemon,
+                           options.parallel, refresh=options.refresh,
+                           sync=options.sync, changes=options.changes,
+                           full_sync_every=options.full_sync_every )
+
+    for region, v, name in named_volumes( volumes, chunk_size, names ):
+        row = [ v['id'], v['tags'].get( 'Name', '' ), v['zone'], v['status'],
+                v['size'], name, v['device'] ]
+        if multi_region:
+            row.insert( 1, region )
+        if options.changes:
+            row.insert( 1, v.get( 'change' ) )
+
+        write( row )
+
+    with ec2stats.phase( 'render' ):
+        out.close()
+
+def main( argv=None ):
+    ( options, args ) = parser.parse_args( argv )
+
+    if options.stats:
+        ec2stats.enable()
+
+    ###################
+    ### Logging
+    ###################
+
+    if options.verbose: log_level = logging.DEBUG
+    else:               log_level = logging.INFO
+
+    logging.basicConfig(stream=sys.stdout, level=log_level)
+    logging.basicConfig(stream=sys.stderr, level=(logging.ERROR,logging.CRITICAL))
+
+    list_volumes( options )
+
+    ### the output is incomplete; don't let a script take it for all there is
+    if FAILED_REGIONS:
+        sys.stderr.write( "failed: %s\n" % ', '.join( sorted( set( FAILED_REGIONS ) ) ) )
+        sys.exit( 1 )
 
 if __name__ == '__main__':
-    list_volumes()
+    ### streaming formats get piped into head & co; die quietly when they exit
+    signal.signal( signal.SIGPIPE, signal.SIG_DFL )
+    main()